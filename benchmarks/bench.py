@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+
+    HTTP benchmark of the main BreakBlog views.
+
+    Builds the application with the testing config (in-memory SQLite) or a file database,
+    seeds fake data of the given scale and drives the views through the WSGI test client:
+
+        python benchmarks/bench.py --scale small --output report.json
+        python benchmarks/bench.py --scale medium --database /tmp/bench.db --reuse \\
+            --baseline benchmarks/baseline.json --tolerance 0.2
+
+    Queries per request are read from the Server-Timing header. With --baseline, the exit
+    status is 1 when a scenario is slower (p95), has lower throughput or runs more queries
+    than the baseline allows.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCALES = {
+    'small': dict(categories=10, posts=100, comments=1000),
+    'medium': dict(categories=50, posts=10000, comments=100000),
+    'large': dict(categories=100, posts=100000, comments=1000000),
+}
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def create_bench_app(args):
+    from breakblog import create_app
+
+    app = create_app('testing')
+    # 引擎在第一次使用时才创建，在这里修改数据库地址仍然有效
+    if args.database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(args.database)
+    app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+    app.config['BREAKBLOG_CACHE_PATH'] = tempfile.mkdtemp(prefix='breakblog-bench-')
+    app.config['BREAKBLOG_PAGINATION'] = args.pagination
+    app.config['BREAKBLOG_PAGEVIEW_MODE'] = args.pageviews
+    # 缓存、浏览量和分页对象在 create_app() 中已经根据配置初始化，修改配置后重新初始化
+    from breakblog.caching import generations, page_cache
+    from breakblog.pageviews import pageviews
+    app.config['BREAKBLOG_PAGE_CACHE'] = args.page_cache
+    generations.init_app(app)
+    page_cache.init_app(app)
+    pageviews.init_app(app)
+    return app
+
+
+def seed(app, scale, args):
+    from breakblog.extensions import db
+    from breakblog.models import Post
+
+    with app.app_context():
+        if args.reuse and args.database and os.path.exists(args.database):
+            db.create_all()
+            if Post.query.count():
+                log('Reusing %s' % args.database)
+                return
+        from breakblog.fakes import fake_admin, fake_bulk, fake_links
+        from breakblog.search import search
+
+        db.drop_all()
+        db.create_all()
+        started = time.time()
+        log('Seeding %(categories)d categories, %(posts)d posts, %(comments)d comments...' % scale)
+        fake_admin()
+        # 固定随机数种子，相同参数生成相同的数据，查询数量可以和基线比较
+        fake_bulk(scale['categories'], scale['posts'], scale['comments'], seed=args.seed)
+        fake_links()
+        search.reindex()
+        db.session.commit()
+        log('Seeded in %.1fs' % (time.time() - started))
+
+
+def scenarios(app):
+    """返回 [(名称, 是否需要登录, 生成 (method, url, data) 的函数)]。"""
+    from breakblog.extensions import db
+    from breakblog.models import Post, Category
+
+    with app.app_context():
+        post_ids = [row[0] for row in db.session.query(Post.id)]
+        category_ids = [row[0] for row in db.session.query(Category.id)]
+        pages = max((len(post_ids) - 1) // app.config['BREAKBLOG_POST_PER_PAGE'] + 1, 1)
+        # 标题中的第一个词作为搜索关键字
+        words = [title.split()[0] for title, in db.session.query(Post.title).limit(50) if title.split()]
+
+    if app.config['BREAKBLOG_PAGINATION'] == 'keyset':
+        deep_page = '/?cursor=last'
+    else:
+        deep_page = '/?page=%d' % pages
+
+    def comment_form():
+        return dict(author='bench', email='bench@example.com', site='', body='Benchmark comment.')
+
+    return [
+        ('blog.index', False, lambda: ('GET', '/', None)),
+        ('blog.index (deep page)', False, lambda: ('GET', deep_page, None)),
+        ('blog.show_category', False, lambda: ('GET', '/category/%d' % random.choice(category_ids), None)),
+        ('blog.show_post', False, lambda: ('GET', '/post/%d' % random.choice(post_ids), None)),
+        ('blog.show_post (thread)', False, lambda: ('GET', '/post/%d?view=thread' % random.choice(post_ids), None)),
+        ('blog.show_post POST', False, lambda: ('POST', '/post/%d' % random.choice(post_ids), comment_form())),
+        ('blog.search', False, lambda: ('GET', '/search?q=%s' % random.choice(words or ['a']), None)),
+        ('admin.manage_comment', True, lambda: ('GET', '/admin/comment/manage', None)),
+        ('admin.manage_comment (unread)', True, lambda: ('GET', '/admin/comment/manage?filter=unread', None)),
+    ]
+
+
+def percentile(values, q):
+    # nearest-rank
+    ordered = sorted(values)
+    return ordered[max(int(round(q * len(ordered) + 0.5)) - 1, 0)] if ordered else 0.0
+
+
+def run_scenario(client, make_request, requests, warmup):
+    latencies, queries, errors = [], [], 0
+    for i in range(warmup + requests):
+        method, url, data = make_request()
+        started = time.perf_counter()
+        response = client.open(url, method=method, data=data)
+        elapsed = time.perf_counter() - started
+        if i < warmup:
+            continue
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(elapsed)
+        match = SERVER_TIMING_QUERIES.search(response.headers.get('Server-Timing', ''))
+        if match:
+            queries.append(int(match.group(1)))
+    total = sum(latencies)
+    return dict(
+        requests=requests,
+        errors=errors,
+        rps=round(requests / total, 2) if total else 0.0,
+        mean_ms=round(total / requests * 1000, 3),
+        p50_ms=round(percentile(latencies, 0.50) * 1000, 3),
+        p95_ms=round(percentile(latencies, 0.95) * 1000, 3),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+        queries_per_request=round(sum(queries) / len(queries), 2) if queries else None,
+        max_queries=max(queries) if queries else None,
+    )
+
+
+def compare(report, baseline, tolerance):
+    """返回回归列表：p95 变慢或吞吐量下降超过 tolerance，或每个请求的查询数量增加。"""
+    regressions = []
+    for name, result in report['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.2fms > baseline %.2fms' % (name, result['p95_ms'], base['p95_ms']))
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append('%s: %.1f req/s < baseline %.1f req/s' % (name, result['rps'], base['rps']))
+        if result['queries_per_request'] is not None and base.get('queries_per_request') is not None \
+                and result['queries_per_request'] > base['queries_per_request']:
+            regressions.append('%s: %.2f queries/request > baseline %.2f'
+                               % (name, result['queries_per_request'], base['queries_per_request']))
+    return regressions
+
+
+def log(message):
+    print(message, file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the main BreakBlog views.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--categories', type=int, help='Override the number of categories.')
+    parser.add_argument('--posts', type=int, help='Override the number of posts.')
+    parser.add_argument('--comments', type=int, help='Override the number of comments.')
+    parser.add_argument('--database', help='Use a SQLite file instead of the in-memory database.')
+    parser.add_argument('--reuse', action='store_true', help='Keep the data already in --database.')
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per scenario.')
+    parser.add_argument('--only', action='append', help='Run only the scenarios starting with this name.')
+    parser.add_argument('--pagination', choices=['keyset', 'offset'], default='keyset')
+    parser.add_argument('--pageviews', choices=['immediate', 'buffered'], default='immediate')
+    parser.add_argument('--page-cache', choices=['memory', 'filesystem'], default=None)
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the fake data and the requests.')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout).')
+    parser.add_argument('--baseline', help='Compare with a previous JSON report.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown, default 0.2 (20%%).')
+    args = parser.parse_args(argv)
+
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    app = create_bench_app(args)
+    seed(app, scale, args)
+    random.seed(args.seed)
+
+    anonymous = app.test_client()
+    admin = app.test_client()
+    admin.post('/auth/login', data=dict(username='admin', password='helloworld'))
+
+    results = {}
+    for name, login, make_request in scenarios(app):
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        results[name] = run_scenario(admin if login else anonymous, make_request, args.requests, args.warmup)
+        log('%-32s %8.1f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  %s queries'
+            % (name, results[name]['rps'], results[name]['p50_ms'], results[name]['p95_ms'],
+               results[name]['p99_ms'], results[name]['queries_per_request']))
+
+    report = dict(
+        meta=dict(
+            created=datetime.utcnow().isoformat(), scale=scale, database='file' if args.database else 'memory',
+            pagination=args.pagination, pageviews=args.pageviews, page_cache=args.page_cache,
+            requests=args.requests, python=platform.python_version()),
+        scenarios=results)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            log('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        log('No regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+
+    Query plan regression check of the BreakBlog views (SQLite).
+
+    Seeds fake data like bench.py, requests every view through the WSGI test client,
+    records the SQL statements they execute and runs EXPLAIN QUERY PLAN on each one:
+
+        python benchmarks/query_plans.py --posts 2000 --comments 20000
+        python benchmarks/query_plans.py --database /tmp/bench.db --reuse --verbose
+
+    The exit status is 1 when a statement scans a whole table, scans a whole index although
+    it has a WHERE clause (the index only provides the order, the filter is applied row by
+    row), or sorts with a temporary B-tree. Scans and sorts of the small tables in
+    ALLOWED_SCANS and the ranking sort of FTS5 matches are accepted.
+"""
+import argparse
+import random
+import re
+import sys
+
+from bench import SCALES, create_bench_app, seed, log
+
+# 只有几行数据的表，全表扫描不影响性能
+ALLOWED_SCANS = {'admin', 'category', 'link'}
+
+# "SCAN post" 或旧版本 SQLite 的 "SCAN TABLE post"
+SCAN = re.compile(r'^SCAN (?:TABLE )?(?P<table>\w+)(?P<detail>.*)$')
+TABLE = re.compile(r'^(?:SCAN|SEARCH) (?:TABLE )?(?P<table>\w+)')
+WHERE = re.compile(r'\bWHERE\b', re.I)
+TEMP_SORT = re.compile(r'USE TEMP B-TREE FOR (?:ORDER BY|GROUP BY|DISTINCT|RIGHT PART OF ORDER BY)')
+SKIPPED_STATEMENTS = re.compile(r'^\s*(?:INSERT|PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|CREATE)\b', re.I)
+
+
+def urls(app):
+    """返回 [(是否需要登录, method, url, data)]，覆盖所有读取数据库的视图。"""
+    from breakblog.extensions import db
+    from breakblog.models import Post, Category, Comment
+
+    with app.app_context():
+        post_id = db.session.query(Comment.post_id).group_by(Comment.post_id).order_by(
+            db.func.count(Comment.id).desc()).limit(1).scalar() or db.session.query(Post.id).limit(1).scalar()
+        category_id = db.session.query(Category.id).limit(1).scalar()
+        word = (db.session.query(Post.title).limit(1).scalar() or 'a').split()[0]
+
+    anonymous = [
+        ('GET', '/', None),
+        ('GET', '/?cursor=last', None),
+        ('GET', '/category/%d' % category_id, None),
+        ('GET', '/category/%d?cursor=last' % category_id, None),
+        ('GET', '/post/%d' % post_id, None),
+        ('GET', '/post/%d?cursor=last' % post_id, None),
+        ('GET', '/post/%d?view=thread' % post_id, None),
+        ('POST', '/post/%d' % post_id, dict(author='plan', email='plan@example.com', site='', body='Plan check.')),
+        ('GET', '/search?q=%s' % word, None),
+        ('GET', '/about', None),
+    ]
+    admin = [
+        ('GET', '/admin/post/manage', None),
+        ('GET', '/admin/post/manage?cursor=last', None),
+        ('GET', '/admin/post/%d/edit' % post_id, None),
+        ('GET', '/admin/comment/manage', None),
+        ('GET', '/admin/comment/manage?filter=unread', None),
+        ('GET', '/admin/comment/manage?filter=unread&cursor=last', None),
+        ('GET', '/admin/comment/manage?filter=admin', None),
+        ('GET', '/admin/category/manage', None),
+        ('GET', '/admin/link/manage', None),
+        ('GET', '/admin/settings', None),
+    ]
+    return [(False,) + request for request in anonymous] + [(True,) + request for request in admin]
+
+
+def record_statements(app, requests):
+    """发送请求并返回 {SQL 语句: (参数, 发出该语句的 URL)}，相同的语句只保留第一次。"""
+    from sqlalchemy import event
+    from breakblog.extensions import db
+
+    statements = {}
+    current = [None]
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current[0] is not None and not executemany and not SKIPPED_STATEMENTS.match(statement):
+            statements.setdefault(statement, (parameters, current[0]))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    anonymous = app.test_client()
+    admin = app.test_client()
+    admin.post('/auth/login', data=dict(username='admin', password='helloworld'))
+    try:
+        for login, method, url, data in requests:
+            current[0] = '%s %s' % (method, url)
+            response = (admin if login else anonymous).open(url, method=method, data=data)
+            if response.status_code >= 400:
+                log('WARNING %s returned %d' % (current[0], response.status_code))
+    finally:
+        current[0] = None
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def explain(app, statements):
+    """返回 [(URL, SQL 语句, 查询计划各行, 问题列表)]。"""
+    from breakblog.extensions import db
+
+    results = []
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, (parameters, url) in statements.items():
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+                problems = []
+                virtual = any('VIRTUAL TABLE' in detail for detail in plan)
+                small = all(match.group('table') in ALLOWED_SCANS
+                            for match in (TABLE.match(detail) for detail in plan) if match)
+                for detail in plan:
+                    match = SCAN.match(detail)
+                    if match and match.group('table') not in ALLOWED_SCANS and not virtual:
+                        if 'USING' not in match.group('detail'):
+                            problems.append('full scan of %s' % match.group('table'))
+                        elif WHERE.search(statement):
+                            # 没有 WHERE 的 ORDER BY ... LIMIT 和 COUNT(*) 按索引顺序读取是正常的
+                            problems.append('filtered scan of %s%s' % (match.group('table'), match.group('detail')))
+                    if TEMP_SORT.search(detail) and not virtual and not small:  # FTS5 按相关度排序只涉及匹配的行
+                        problems.append(detail.lower())
+                results.append((url, statement, plan, problems))
+        finally:
+            connection.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the query plans of the BreakBlog views.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--categories', type=int, help='Override the number of categories.')
+    parser.add_argument('--posts', type=int, help='Override the number of posts.')
+    parser.add_argument('--comments', type=int, help='Override the number of comments.')
+    parser.add_argument('--database', help='Use a SQLite file instead of the in-memory database.')
+    parser.add_argument('--reuse', action='store_true', help='Keep the data already in --database.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the fake data.')
+    parser.add_argument('--verbose', action='store_true', help='Print the plan of every statement.')
+    args = parser.parse_args(argv)
+    # 和 bench.py 使用相同的应用配置，页面缓存关闭，每个请求都会查询数据库
+    args.pagination, args.pageviews, args.page_cache = 'keyset', 'immediate', None
+
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    app = create_bench_app(args)
+    seed(app, scale, args)
+    random.seed(args.seed)
+
+    results = explain(app, record_statements(app, urls(app)))
+    failures = 0
+    for url, statement, plan, problems in results:
+        if problems:
+            failures += 1
+        if problems or args.verbose:
+            log('%s %s' % ('FAIL' if problems else 'OK  ', url))
+            log('    ' + ' '.join(statement.split()))
+            for detail in plan:
+                log('    -> ' + detail)
+            for problem in problems:
+                log('    !! ' + problem)
+    log('%d statements checked, %d with full scans or temporary sorts.' % (len(results), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
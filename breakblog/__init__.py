@@ -6,21 +6,38 @@
 """
 import logging
 import os
-from logging.handlers import RotatingFileHandler, SMTPHandler
+import random
+import sys
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
 
 import click
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, make_response
+from flask.logging import default_handler
 from flask_login import current_user
 from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from breakblog.blueprints.admin import admin_bp
 from breakblog.blueprints.auth import auth_bp
 from breakblog.blueprints.blog import blog_bp
+from breakblog.caching import generations, site_context, page_cache, principals
 from breakblog.extensions import bootstrap, db, moment, csrf, ckeditor, login_manager, mail, toolbar, migrate
 
-from breakblog.models import Admin, Category, Post, Comment, Link
+from breakblog.models import Admin, Category, Post, Comment, OutboxMessage
+from breakblog.export import export_site
+from breakblog.feeds import feeds
+from breakblog.images import images
+from breakblog.logs import JSONFormatter, LogPipeline, QueueLogHandler, ErrorDigestHandler
+from breakblog.metrics import metrics
+from breakblog.outbox import outbox, drain_all
+from breakblog.pageviews import pageviews
+from breakblog.ratelimit import ratelimit
+from breakblog.rendering import render_post
+from breakblog.search import search
 from breakblog.settings import config
+from breakblog.sitemaps import sitemaps
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -33,6 +50,8 @@ def create_app(config_name=None):
 
     app = Flask('breakblog')
     app.config.from_object(config[config_name])  # 从settings.py中导入配置文件
+    if app.config['BREAKBLOG_PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['BREAKBLOG_PROXY_COUNT'])
 
     register_logging(app)  # 注册日志处理器
     register_extensions(app)  # 注册扩展（扩展初始化）
@@ -46,38 +65,38 @@ def create_app(config_name=None):
 
 
 # 注册日志处理器
+# 请求线程只把日志放入队列，由 QueueListener 的后台线程写入文件（每行一条 JSON）、输出到 stderr，
+# 错误日志按异常签名合并后定时发送汇总邮件
 def register_logging(app):
-    class RequestFormatter(logging.Formatter):
-        def format(self, record):
-            record.url = request.url
-            record.remote_addr = request.remote_addr
-            return super(RequestFormatter, self).format(record)
-
-    request_formatter = RequestFormatter(
-        '[%(asctime)s] %(remote_addr)s requested %(url)s\n'
-        '%(levelname)s in %(module)s: %(message)s'
-    )
-
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if app.debug:  # 调试模式使用 Flask 默认的日志输出
+        return
 
     file_handler = RotatingFileHandler(os.path.join(basedir, 'logs/breakblog.log'),
                                        maxBytes=10 * 1024 * 1024, backupCount=10)
-    file_handler.setFormatter(formatter)
+    file_handler.setFormatter(JSONFormatter())
     file_handler.setLevel(logging.INFO)
 
-    mail_handler = SMTPHandler(
-        mailhost=app.config['MAIL_SERVER'],
-        fromaddr=app.config['MAIL_USERNAME'],
-        toaddrs=['ADMIN_EMAIL'],
-        subject='Breakblog Application Error',
-        credentials=(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']))
-    mail_handler.setLevel(logging.ERROR)
-    mail_handler.setFormatter(request_formatter)
-
-    if not app.debug:
-        app.logger.addHandler(mail_handler)
-        app.logger.addHandler(file_handler)
+    stream_handler = logging.StreamHandler(sys.stderr)  # 代替 Flask 在请求线程中输出的默认处理器
+    stream_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+    handlers = [file_handler, stream_handler]
+
+    if app.config['MAIL_SERVER'] and app.config['BREAKBLOG_EMAIL']:
+        handlers.append(ErrorDigestHandler(
+            mailhost=app.config['MAIL_SERVER'],
+            port=app.config['MAIL_PORT'],
+            fromaddr=app.config['MAIL_USERNAME'],
+            toaddrs=[app.config['BREAKBLOG_EMAIL']],
+            subject='Breakblog Application Error',
+            credentials=(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']),
+            use_tls=app.config.get('MAIL_USE_TLS', False),
+            use_ssl=app.config.get('MAIL_USE_SSL', False),
+            interval=app.config['BREAKBLOG_ERROR_MAIL_INTERVAL'],
+            throttle=app.config['BREAKBLOG_ERROR_MAIL_THROTTLE']))
+
+    app.logger.removeHandler(default_handler)
+    queue_handler = QueueLogHandler(LogPipeline(handlers, app.config['BREAKBLOG_LOG_QUEUE_SIZE']))
+    queue_handler.setLevel(logging.INFO)
+    app.logger.addHandler(queue_handler)
 
 
 # 注册扩展（扩展初始化）
@@ -91,7 +110,19 @@ def register_extensions(app):
     mail.init_app(app)
     moment.init_app(app)
     toolbar.init_app(app)
-    migrate.init_app(app, db)
+    migrate.init_app(app, db, render_as_batch=True)  # SQLite 不支持大部分 ALTER TABLE 操作，使用批处理模式
+    generations.init_app(app)
+    site_context.init_app(app)
+    principals.init_app(app)
+    page_cache.init_app(app)
+    pageviews.init_app(app)
+    search.init_app(app)
+    outbox.init_app(app)
+    metrics.init_app(app)
+    images.init_app(app)
+    feeds.init_app(app)
+    sitemaps.init_app(app)
+    ratelimit.init_app(app)
 
 
 # 注册蓝本
@@ -114,6 +145,10 @@ def register_commands(app):
             db.drop_all()
             click.echo('Drop tables.')
         db.create_all()
+        search.reindex()  # 删除数据表后清空搜索索引
+        db.session.commit()
+        site_context.invalidate()
+        site_context.invalidate_comments()
         click.echo('Initialized database.')
 
     # flask init 初始化创建管理员帐号
@@ -144,6 +179,7 @@ def register_commands(app):
             )
             admin.set_password(password)
             db.session.add(admin)
+        principals.invalidate()  # 用户名或密码变化，已登录的 session 需要重新验证
 
         category = Category.query.first()
         if category is None:
@@ -152,33 +188,138 @@ def register_commands(app):
             db.session.add(category)
 
         db.session.commit()
+        site_context.invalidate()
         click.echo('Done.')
 
     # flask forge 命令默认生成10个分类、50篇文章、500条评论
     # flask forge --category=20 --post=100 --comment=1000 命令生成20个分类、100篇文章、1000条评论
+    # flask forge --bulk --post=100000 --comment=1000000 --seed=1 批量生成大量数据
     @app.cli.command()
     @click.option('--category', default=10, help='Quantity of categories, default is 10.')
     @click.option('--post', default=50, help='Quantity of posts, default is 50.')
     @click.option('--comment', default=500, help='Quantity of comments, default is 500.')
-    def forge(category, post, comment):
+    @click.option('--bulk', is_flag=True, help='Insert rows in chunks, for large quantities.')
+    @click.option('--seed', type=int, help='Random seed, the same seed generates the same data.')
+    @click.option('--chunk-size', default=10000, help='Rows per insert in bulk mode, default is 10000.')
+    def forge(category, post, comment, bulk, seed, chunk_size):
         """Generate fake data."""
-        from breakblog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links
+        from breakblog.fakes import fake, fake_admin, fake_categories, fake_posts, fake_comments, fake_links, \
+            fake_bulk
         # p240 更全面地生成虚拟数据，先删除再重建数据库表
         db.drop_all()
         db.create_all()
         # p240 生成虚拟数据顺序必须是 管理员-分类-文章-评论，links随意
         click.echo('Generating the administrator...')
         fake_admin()
-        click.echo('Generating %d categories...' % category)
-        fake_categories(category)
-        click.echo('Generating %d posts...' % post)
-        fake_posts(post)
-        click.echo('Generating %d comments...' % comment)
-        fake_comments(comment)
+        if bulk:
+            click.echo('Generating %d categories, %d posts and %d comments...' % (category, post, comment))
+            with click.progressbar(length=post + comment, label='Inserting') as bar:
+                fake_bulk(category, post, comment, seed=seed, chunk_size=chunk_size, progress=bar.update)
+        else:
+            if seed is not None:
+                random.seed(seed)
+                fake.seed_instance(seed)
+            click.echo('Generating %d categories...' % category)
+            fake_categories(category)
+            click.echo('Generating %d posts...' % post)
+            fake_posts(post)
+            click.echo('Generating %d comments...' % comment)
+            fake_comments(comment)
         click.echo('Generating links...')
         fake_links()
+        click.echo('Indexing posts...')
+        search.reindex()
+        db.session.commit()
+        site_context.invalidate()
+        site_context.invalidate_comments()
+        click.echo('Done.')
+
+    # flask recount 根据评论表重新计算所有文章的评论数量
+    @app.cli.command()
+    def recount():
+        """Recompute the comment counters of all posts."""
+        click.echo('Recounting comments...')
+        Post.recount_comments()
+        db.session.commit()
+        site_context.invalidate()  # 列表页中的评论数量变化
         click.echo('Done.')
 
+    # flask reindex 重建文章全文搜索索引
+    @app.cli.command()
+    def reindex():
+        """Rebuild the full-text search index of posts."""
+        if not search.available:
+            raise click.ClickException('Full-text search requires SQLite with the FTS5 extension.')
+        click.echo('Indexing posts...')
+        count = search.reindex()
+        db.session.commit()
+        click.echo('Indexed %d posts.' % count)
+
+    # flask render-posts 为已有的文章生成过滤后的 HTML、摘要、字数和目录
+    @app.cli.command('render-posts')
+    @click.option('--all', 'render_all', is_flag=True, help='Re-render every post, not only the missing ones.')
+    @click.option('--chunk-size', default=500, help='Posts updated per transaction, default is 500.')
+    def render_posts(render_all, chunk_size):
+        """Precompute the HTML, excerpt, word count and TOC of posts."""
+        post = Post.__table__
+        count, last_id = 0, 0
+        while True:  # 按 id 分块处理，每块提交一次
+            query = db.select([post.c.id, post.c.body]).where(post.c.id > last_id)
+            if not render_all:
+                query = query.where(post.c.body_html == None)  # noqa: E711
+            rows = db.session.execute(query.order_by(post.c.id).limit(chunk_size)).fetchall()
+            if not rows:
+                break
+            db.session.execute(
+                post.update().where(post.c.id == db.bindparam('post_id')),
+                [dict(render_post(row.body), post_id=row.id) for row in rows])
+            db.session.commit()
+            count += len(rows)
+            last_id = rows[-1].id
+        site_context.invalidate()  # 缓存的页面中还是旧的内容
+        click.echo('Rendered %d posts.' % count)
+
+    # flask export 把公开页面渲染成静态文件，由 nginx 直接发送，再次导出时只重新生成变化的页面
+    @app.cli.command()
+    @click.option('--output', type=click.Path(file_okay=False), help='Output directory, default is BREAKBLOG_EXPORT_PATH.')
+    @click.option('--workers', default=os.cpu_count() or 1, help='Rendering processes, default is the CPU count.')
+    @click.option('--base-url', default='http://localhost/', help='Scheme and host of the absolute URLs.')
+    @click.option('--full', is_flag=True, help='Re-render every page, ignoring the manifest.')
+    def export(output, workers, base_url, full):
+        """Render the public pages to static HTML files."""
+        output = output or app.config['BREAKBLOG_EXPORT_PATH']
+        if ':memory:' in app.config['SQLALCHEMY_DATABASE_URI']:
+            workers = 1  # 内存数据库无法在进程之间共享
+
+        def progress(done, total):
+            click.echo('\rRendering pages: %d/%d' % (done, total), nl=done == total)
+
+        rendered, removed, failed = export_site(app, output, workers, base_url, full, progress=progress)
+        for path, status in failed:
+            click.echo('Failed to render %s (%d)' % (path, status), err=True)
+        click.echo('Rendered %d pages, removed %d pages in %s.' % (rendered, removed, output))
+
+    # flask mail-worker 在单独的进程中发送发件箱中的邮件，此时可以把 BREAKBLOG_MAIL_WORKERS 设为 0
+    @app.cli.command('mail-worker')
+    @click.option('--once', is_flag=True, help='Send the due messages and exit.')
+    @click.option('--retry-dead', is_flag=True, help='Requeue the messages that ran out of attempts.')
+    def mail_worker(once, retry_dead):
+        """Send the queued emails in the outbox."""
+        import time
+
+        if retry_dead:
+            count = OutboxMessage.query.filter_by(status='dead').update(
+                dict(status='pending', attempts=0, next_attempt_at=datetime.utcnow()), synchronize_session=False)
+            db.session.commit()
+            click.echo('Requeued %d messages.' % count)
+        while True:
+            count = drain_all(app)
+            if count:
+                click.echo('Processed %d messages.' % count)
+            if once:
+                break
+            time.sleep(app.config['BREAKBLOG_MAIL_POLL_INTERVAL'])
+
 
 # 注册错误处理函数
 def register_errors(app):
@@ -190,6 +331,13 @@ def register_errors(app):
     def page_not_found(e):
         return render_template('errors/404.html'), 404
 
+    @app.errorhandler(429)
+    def too_many_requests(e):
+        response = make_response(render_template('errors/429.html'), 429)
+        if getattr(e, 'retry_after', None):
+            response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
     @app.errorhandler(500)
     def internal_server_error(e):
         return render_template('errors/500.html'), 500
@@ -212,22 +360,25 @@ def register_shell_context(app):
 def register_template_context(app):
     @app.context_processor
     def make_template_context():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
-        # p284 管理员登录后，查询待审核评论的数量
+        # 管理员信息、分类和链接很少变化，从缓存中读取，只有版本戳变化后才重新查询数据库
+        context = site_context.get()
+        # p284 管理员登录后，显示待审核评论的数量
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(
-                reviewed=False).count()  # unread_comments 储存待审核评论的数量
+            unread_comments = context['unread_comments']  # unread_comments 储存待审核评论的数量
         else:
             unread_comments = None
         return dict(
-            admin=admin, categories=categories,
-            links=links, unread_comments=unread_comments)
+            admin=context['admin'], categories=context['categories'],
+            links=context['links'], unread_comments=unread_comments)
 # 注册请求上下文处理函数
 
 
 def register_request_handlers(app):
+    # 博客前台的 GET 请求只读取数据，开启读写分离时查询交给只读引擎（见 breakblog.database）
+    @app.before_request
+    def route_reads():
+        db.session.info['read_only'] = request.blueprint == 'blog' and request.method in ('GET', 'HEAD')
+
     @app.after_request
     def query_profiler(response):
         for q in get_debug_queries():
@@ -4,15 +4,20 @@
     :github_url: https://github.com/tw-huang
     :email: tw.huang@foxmail.com
 """
-import os
+import hmac
+from datetime import datetime
 
-from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, send_from_directory
+from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort, jsonify
 from flask_login import login_required, current_user
-from flask_ckeditor import upload_success, upload_fail
+from flask_ckeditor import upload_fail
 
+from breakblog.caching import site_context, page_cache, principals
 from breakblog.extensions import db
-from breakblog.forms import SettingForm, PostForm, CategoryForm, LinkForm
-from breakblog.models import Post, Category, Comment, Link
+from breakblog.images import images
+from breakblog.forms import SettingForm, PostForm, CategoryForm, MergeCategoryForm, LinkForm
+from breakblog.models import Admin, Post, Category, Comment, Link
+from breakblog.pagination import paginate, approximate_count
+from breakblog.search import search
 from breakblog.utils import redirect_back, allowed_file
 
 admin_bp = Blueprint('admin', __name__)
@@ -23,11 +28,15 @@ admin_bp = Blueprint('admin', __name__)
 def settings():
     form = SettingForm()
     if form.validate_on_submit():
-        current_user.name = form.name.data
-        current_user.blog_title = form.blog_title.data
-        current_user.blog_sub_title = form.blog_sub_title.data
-        current_user.about = form.about.data
+        # current_user 是缓存的只读副本，修改数据库中的管理员记录
+        admin = Admin.query.get_or_404(current_user.id)
+        admin.name = form.name.data
+        admin.blog_title = form.blog_title.data
+        admin.blog_sub_title = form.blog_sub_title.data
+        admin.about = form.about.data
         db.session.commit()
+        site_context.invalidate()  # 博客标题等信息变化，通知各 worker 重新加载模板上下文
+        principals.invalidate()
         flash('Setting updated.', 'success')
         return redirect(url_for('blog.index'))
     form.name.data = current_user.name
@@ -41,11 +50,10 @@ def settings():
 @admin_bp.route('/post/manage')
 @login_required
 def manage_post():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['BREAKBLOG_MANAGE_POST_PER_PAGE'])
+    pagination = paginate(Post.query, Post, current_app.config['BREAKBLOG_MANAGE_POST_PER_PAGE'],
+                          total=approximate_count('posts', Post.query))
     posts = pagination.items
-    return render_template('admin/manage_post.html', page=page, pagination=pagination, posts=posts)
+    return render_template('admin/manage_post.html', pagination=pagination, posts=posts)
 
 
 # p288 创建文章
@@ -63,8 +71,12 @@ def new_post():
         # 另一种方法
         # category_id = form.category.data
         # post = Post(title=title, body=body, category_id=category_id)
+        post.render()
         db.session.add(post)
+        db.session.flush()  # 获得文章 id 后在同一个事务中写入搜索索引
+        search.index_post(post)
         db.session.commit()
+        site_context.invalidate()  # 分类文章数量变化
         flash('Post created.', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     return render_template('admin/new_post.html', form=form)
@@ -81,11 +93,19 @@ def edit_post(post_id):
     form = PostForm()
     post = Post.query.get_or_404(post_id)
     if form.validate_on_submit():
+        category_id = post.category_id
         post.title = form.title.data
         post.subtitle = form.subtitle.data
         post.body = form.body.data
         post.category = Category.query.get(form.category.data)
+        post.updated_at = datetime.utcnow()
+        post.render()
+        search.index_post(post)
         db.session.commit()
+        if post.category_id != category_id:
+            site_context.invalidate()  # 分类文章数量变化，所有页面的侧边栏都需要更新
+        else:
+            page_cache.invalidate_post(post)
         flash('Post updated.', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     form.title.data = post.title  # 预定义表单中的title字段值
@@ -100,8 +120,13 @@ def edit_post(post_id):
 @login_required
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
+    search.remove_post(post.id)
+    # 其他文章下的回复可能回复了这篇文章的评论，和评论一起级联删除后重新计算它们所在文章的评论数量
+    Comment.bulk_delete([Comment.post_id == post.id])
     db.session.delete(post)
     db.session.commit()
+    site_context.invalidate()
+    site_context.invalidate_comments()  # 文章的待审核评论一起删除
     flash('Post deleted.', 'success')
     return redirect_back()
 
@@ -118,6 +143,7 @@ def set_comment(post_id):
         post.can_comment = True
         flash('Comment enabled.', 'success')
     db.session.commit()
+    page_cache.invalidate('post:%d' % post.id)
     return redirect_back()
 
 
@@ -126,28 +152,77 @@ def set_comment(post_id):
 @login_required
 def manage_comment():
     filter_rule = request.args.get('filter', 'all')  # 从查询字符串获取过滤规则
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BREAKBLOG_COMMENT_PER_PAGE']
-    if filter_rule == 'unread':
-        filtered_comments = Comment.query.filter_by(reviewed=False)
-    elif filter_rule == 'admin':
-        filtered_comments = Comment.query.filter_by(from_admin=True)
-    else:
-        filtered_comments = Comment.query
+    filtered_comments = Comment.query.filter(*_comment_criteria(filter_rule))
 
-    pagination = filtered_comments.order_by(
-        Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(filtered_comments, Comment, per_page,
+                          total=approximate_count('comments:%s' % filter_rule, filtered_comments))
     comments = pagination.items
     return render_template('admin/manage_comment.html', comments=comments, pagination=pagination)
 
 
+def _comment_criteria(filter_rule):
+    if filter_rule == 'unread':
+        return [Comment.reviewed == False]  # noqa: E712
+    if filter_rule == 'admin':
+        return [Comment.from_admin == True]  # noqa: E712
+    return []
+
+
+def _invalidate_comment_posts(posts):
+    """评论变化后清除待审核数量和 posts [(文章 id, 分类 id)] 相关页面的缓存。"""
+    if posts:
+        site_context.invalidate_comments()
+        tags = {'posts'}
+        for post_id, category_id in posts:
+            tags.update(('post:%d' % post_id, 'category:%d' % category_id))
+        page_cache.invalidate(*tags)
+
+
+# 批量审核或删除评论，在一个事务中执行
+# 选中的评论 ids，或者过滤规则 filter 加上可选的 email、site（例如删除某个邮箱的所有待审核评论）
+@admin_bp.route('/comment/bulk', methods=['POST'])
+@login_required
+def bulk_comments():
+    action = request.form.get('action')
+    if action not in ('approve', 'delete'):
+        abort(400)
+    ids = request.form.getlist('ids', type=int)
+    email = request.form.get('email', '').strip()
+    site = request.form.get('site', '').strip()
+    if ids:
+        criteria = [Comment.id.in_(ids)]
+    else:
+        criteria = _comment_criteria(request.form.get('filter', 'all'))
+        if email:
+            criteria.append(Comment.email == email)
+        if site:
+            criteria.append(Comment.site == site)
+    if not criteria:  # 不允许一次处理所有评论
+        flash('No comments selected.', 'warning')
+        return redirect_back()
+
+    if action == 'approve':
+        count, posts = Comment.bulk_approve(criteria)
+    else:
+        count, posts = Comment.bulk_delete(criteria)  # 包括被级联删除的回复
+    db.session.commit()
+    _invalidate_comment_posts(posts)
+    flash('%d comments %s.' % (count, 'published' if action == 'approve' else 'deleted'), 'success')
+    return redirect_back()
+
+
 # p294 批准评论
 @admin_bp.route('/comment/<int:comment_id>/approve', methods=['POST'])
 @login_required
 def approve_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    comment.reviewed = True
-    db.session.commit()
+    if not comment.reviewed:
+        comment.reviewed = True
+        comment.post.reviewed_comment_count = Post.reviewed_comment_count + 1
+        db.session.commit()
+        site_context.invalidate_comments()  # 待审核评论数量变化
+        page_cache.invalidate_post(comment.post)
     flash('Comment published.', 'success')
     return redirect_back()
 
@@ -157,8 +232,10 @@ def approve_comment(comment_id):
 @login_required
 def delete_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    db.session.delete(comment)
+    # 回复随之级联删除，回复可能属于其他文章，重新计算整棵回复树涉及的所有文章的评论数量
+    posts = Comment.bulk_delete([Comment.id == comment.id])[1]
     db.session.commit()
+    _invalidate_comment_posts(posts)
     flash('Comment deleted.', 'success')
     return redirect_back()
 
@@ -179,6 +256,7 @@ def new_category():
         category = Category(name=name)
         db.session.add(category)
         db.session.commit()
+        site_context.invalidate()
         flash('Category created.', 'success')
         return redirect(url_for('.manage_category'))
     return render_template('admin/new_category.html', form=form)
@@ -195,6 +273,7 @@ def edit_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        site_context.invalidate()
         flash('Category updated.', 'success')
         return redirect(url_for('.manage_category'))
 
@@ -214,6 +293,23 @@ def delete_category(category_id):
     return redirect(url_for('.manage_category'))
 
 
+# 合并分类：文章移动到目标分类，然后删除该分类
+@admin_bp.route('/category/<int:category_id>/merge', methods=['GET', 'POST'])
+@login_required
+def merge_category(category_id):
+    category = Category.query.get_or_404(category_id)
+    if category.id == 1:
+        flash('You can not merge the default category.', 'warning')
+        return redirect(url_for('.manage_category'))
+    form = MergeCategoryForm(category)
+    if form.validate_on_submit():
+        target = Category.query.get_or_404(form.target.data)
+        category.merge_into(target)
+        flash('Category merged into %s.' % target.name, 'success')
+        return redirect(url_for('.manage_category'))
+    return render_template('admin/merge_category.html', form=form, category=category)
+
+
 @admin_bp.route('/link/manage')
 @login_required
 def manage_link():
@@ -230,6 +326,7 @@ def new_link():
         link = Link(name=name, url=url)
         db.session.add(link)
         db.session.commit()
+        site_context.invalidate()
         flash('Link created.', 'success')
         return redirect(url_for('.manage_link'))
     return render_template('admin/new_link.html', form=form)
@@ -244,6 +341,7 @@ def edit_link(link_id):
         link.name = form.name.data
         link.url = form.url.data
         db.session.commit()
+        site_context.invalidate()
         flash('Link updated.', 'success')
         return redirect(url_for('.manage_link'))
     form.name.data = link.name
@@ -257,21 +355,62 @@ def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
     db.session.commit()
+    site_context.invalidate()
     flash('Link deleted.', 'success')
     return redirect(url_for('.manage_link'))
 
 
+# 当前进程按端点汇总的请求指标
+@admin_bp.route('/metrics')
+@login_required
+def show_metrics():
+    registry = current_app.extensions['breakblog_metrics']
+    if registry is None:
+        abort(404)
+    stats = sorted(registry.snapshot().items(), key=lambda item: item[1].duration, reverse=True)
+    return render_template('admin/metrics.html', stats=stats, started=datetime.utcfromtimestamp(registry.started))
+
+
+@admin_bp.route('/metrics/reset', methods=['POST'])
+@login_required
+def reset_metrics():
+    registry = current_app.extensions['breakblog_metrics']
+    if registry is not None:
+        registry.reset()
+    flash('Metrics reset.', 'success')
+    return redirect(url_for('.show_metrics'))
+
+
+# Prometheus 文本格式，登录后或者使用 Authorization: Bearer <BREAKBLOG_METRICS_TOKEN> 访问
+@admin_bp.route('/metrics/prometheus')
+def prometheus_metrics():
+    registry = current_app.extensions['breakblog_metrics']
+    if registry is None:
+        abort(404)
+    token = current_app.config['BREAKBLOG_METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not current_user.is_authenticated and not (
+            token and hmac.compare_digest(authorization, 'Bearer %s' % token)):
+        return current_app.login_manager.unauthorized()
+    return current_app.response_class(registry.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 @admin_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['BREAKBLOG_UPLOAD_PATH'], filename)
+    return images.send(filename)
 
 
+# 编辑器上传图片，原图以内容的散列值命名，返回的 srcset 列出各宽度版本的地址
 @admin_bp.route('/upload', methods=['POST'])
+@login_required
 def upload_image():
     f = request.files.get('upload')
-    if not allowed_file(f.filename):
+    if f is None or not allowed_file(f.filename):
         return upload_fail('Image only!')
-    f.save(os.path.join(
-        current_app.config['BREAKBLOG_UPLOAD_PATH'], f.filename))
-    url = url_for('.get_image', filename=f.filename)
-    return upload_success(url, f.filename)
+    saved = images.save(f)
+    if saved is None:
+        return upload_fail('Invalid image!')
+    filename, width, height = saved
+    url = url_for('.get_image', filename=filename)
+    return jsonify(uploaded=1, fileName=filename, url=url, width=width, height=height,
+                   srcset=images.srcset(filename, width))
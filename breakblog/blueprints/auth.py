@@ -7,7 +7,9 @@
 from flask import render_template, flash, redirect, url_for, Blueprint
 from flask_login import login_user, logout_user, login_required, current_user
 
+from breakblog.caching import principals
 from breakblog.forms import LoginForm
+from breakblog.ratelimit import ratelimit
 from breakblog.models import Admin
 from breakblog.utils import redirect_back
 
@@ -15,6 +17,7 @@ auth_bp = Blueprint('auth', __name__)
 
 # p277 登入用户
 @auth_bp.route('/login', methods=['GET', 'POST'])
+@ratelimit.limit('login')  # 每次验证密码都要计算一次 PBKDF2
 def login():
     if current_user.is_authenticated:  # p278 避免已经登录的用户不小心访问这个视图，如果是，重定向到首页
         return redirect(url_for('blog.index'))
@@ -28,6 +31,7 @@ def login():
         if admin:
             if username == admin.username and admin.validate_password(password):
                 login_user(admin, remember)
+                principals.remember(admin)
                 flash('Welcome back.', 'info')
                 return redirect_back()
             flash('Invalid username or password.', 'warning')
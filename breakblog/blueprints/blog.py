@@ -6,44 +6,62 @@
 """
 from flask import Blueprint, render_template, request, current_app, flash, redirect, url_for
 from flask_login import current_user
+from flask_sqlalchemy import Pagination
 
+from breakblog.caching import site_context, page_cache
 from breakblog.emails import send_new_reply_email, send_new_comment_email
 from breakblog.extensions import db
+from breakblog.feeds import feeds
 from breakblog.forms import AdminCommentForm, CommentForm
 from breakblog.models import Post, Category, Comment
+from breakblog.pageviews import pageviews
+from breakblog.pagination import paginate
+from breakblog.ratelimit import ratelimit
+from breakblog.search import search
+from breakblog.sitemaps import sitemaps
 from breakblog.utils import redirect_back
 
 blog_bp = Blueprint('blog', __name__)
 
 
 @blog_bp.route('/')
+@page_cache.cached('site', 'posts')
 def index():
-    # p254 获取分页记录
-    page = request.args.get('page', 1, type=int)  # 从查询字符串获取当前页面
+    # p254 获取分页记录，默认使用基于 (timestamp, id) 的游标分页
     per_page = current_app.config['BREAKBLOG_POST_PER_PAGE']  # 每页文章数量
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=per_page)  # 分页对象
+    pagination = paginate(Post.query, Post, per_page)  # 分页对象
     posts = pagination.items  # 当前页数的记录列表
     return render_template('blog/index.html', pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/about')
+@page_cache.cached('site')
 def about():
     return render_template('blog/about.html')
 
 
 # p258 p263 p266 显示文章正文、显示评论列表、发表评论与回复
 @blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@ratelimit.limit('comment')  # 发表评论需要写入数据库和发送邮件
+@pageviews.counted
+@page_cache.cached('site', 'post:{post_id}')
 def show_post(post_id):
     # p258 get_or_404()方法查询指定id记录，没有就返回404错误
-    post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
+    post = Post.query.options(db.undefer(Post.body_html)).get_or_404(post_id)
     per_page = current_app.config['BREAKBLOG_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).filter_by(reviewed=True).order_by(Comment.timestamp.asc()).paginate(
-        page, per_page)
+    threaded = request.args.get('view') == 'thread'
+    if threaded:
+        # 树形显示：一次查询加载全部评论，按顶层评论分页
+        page = request.args.get('page', 1, type=int)
+        roots, replies = Comment.thread(post)
+        start = (page - 1) * per_page
+        pagination = Pagination(None, page, per_page, len(roots), roots[start:start + per_page])
+    else:
+        # 被回复的评论和当前页评论在同一条查询中加载，模板读取 comment.replied 时不再逐条查询
+        query = Comment.query.with_parent(post).filter_by(reviewed=True).options(db.joinedload(Comment.replied))
+        pagination = paginate(query, Comment, per_page, descending=False, total=post.reviewed_comment_count)
+        replies = None
     comments = pagination.items
-    post.pageview = post.pageview + 1  # 文章浏览量+1
-    db.session.commit()  # p151 更新记录直接赋值，然后commit()即可
 
     # current_user.is_authenticated 从 flask-login 包导入
     if current_user.is_authenticated:  # p267 如果当前用户已登录，使用管理员表单
@@ -66,35 +84,94 @@ def show_post(post_id):
         comment = Comment(
             author=author, email=email, site=site, body=body,
             from_admin=from_admin, post=post, reviewed=reviewed)
+        # 在同一个事务中更新文章的评论计数
+        post.comment_count = Post.comment_count + 1
+        if reviewed:
+            post.reviewed_comment_count = Post.reviewed_comment_count + 1
         replied_id = request.args.get('reply')
         if replied_id:  # 如果url中reply查询参数存在，那么说明是回复
-            replied_comment = Comment.query.get_or_404(replied_id)
+            # 只能回复同一篇文章下的评论，否则删除评论时级联删除的回复会分散在多篇文章中
+            replied_comment = Comment.query.with_parent(post).filter_by(id=replied_id).first_or_404()
             comment.replied = replied_comment
-            send_new_reply_email(replied_comment)  # 发送邮件给被回复用户
+            send_new_reply_email(replied_comment)  # 发送邮件给被回复用户（写入发件箱）
         db.session.add(comment)
+        if not current_user.is_authenticated:
+            send_new_comment_email(post)  # 提醒邮件和评论在同一个事务中写入发件箱
         db.session.commit()
+        site_context.invalidate_comments()  # 待审核评论数量变化
+        if reviewed:  # 管理员的评论直接显示，文章页和列表中的评论数量随之变化
+            page_cache.invalidate_post(post)
         if current_user.is_authenticated:  # 根据登录状态显示不同的提示信息
             flash('Comment published.', 'success')
         else:
             flash('Thanks, your comment will be published after reviewed.', 'info')
-            send_new_comment_email(post)  # 发送提醒邮件给管理员
         return redirect(url_for('.show_post', post_id=post_id))
-    return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
+    return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments,
+                           replies=replies, threaded=threaded)
 
 
 # p262 显示分类文章列表
 @blog_bp.route('/category/<int:category_id>')
+@page_cache.cached('site', 'category:{category_id}')
 def show_category(category_id):
     category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BREAKBLOG_POST_PER_PAGE']
     # with_parent()查询方法传入分类对象，筛选出属于该分类的所有文章记录
-    pagination = Post.query.with_parent(category).order_by(
-        Post.timestamp.desc()).paginate(page, per_page)
+    pagination = paginate(Post.query.with_parent(category), Post, per_page, total=category.post_count)
     posts = pagination.items
     return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
+# 全站的 Atom 订阅，新文章、编辑或删除文章后重新生成
+@blog_bp.route('/feed.xml')
+def feed():
+    def build():
+        return feeds.render(feeds.latest_posts(Post.query), self_url=url_for('.feed', _external=True),
+                            alternate=url_for('.index', _external=True), category=None)
+
+    return feeds.response('site', ['site', 'posts'], build)
+
+
+# 单个分类的 Atom 订阅
+@blog_bp.route('/category/<int:category_id>/feed.xml')
+def category_feed(category_id):
+    def build():
+        category = Category.query.get_or_404(category_id)
+        return feeds.render(feeds.latest_posts(Post.query.with_parent(category)),
+                            self_url=url_for('.category_feed', category_id=category_id, _external=True),
+                            alternate=url_for('.show_category', category_id=category_id, _external=True),
+                            category=category)
+
+    return feeds.response('category:%d' % category_id, ['site', 'category:%d' % category_id], build)
+
+
+# sitemap 索引和子 sitemap，见 breakblog.sitemaps
+@blog_bp.route('/sitemap.xml')
+def sitemap():
+    return sitemaps.index()
+
+
+@blog_bp.route('/sitemap-pages.xml.gz')
+def sitemap_pages():
+    return sitemaps.pages()
+
+
+@blog_bp.route('/sitemap-posts-<int:number>.xml.gz')
+def sitemap_posts(number):
+    return sitemaps.posts(number)
+
+
+# 全文搜索，按相关度排序
+@blog_bp.route('/search', endpoint='search')
+def search_posts():
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['BREAKBLOG_SEARCH_PER_PAGE']
+    pagination = search.search(q, page, per_page)
+    return render_template('blog/search.html', q=q, pagination=pagination, results=pagination.items,
+                           available=search.available)
+
+
 # p263 p267 显示评论列表、支持回复评论
 @blog_bp.route('/reply/comment/<int:comment_id>')
 def reply_comment(comment_id):
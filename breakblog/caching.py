@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from types import SimpleNamespace
+
+from flask import current_app, request, session, g, make_response, get_flashed_messages
+from flask_login import current_user, UserMixin
+from flask_wtf.csrf import generate_csrf
+from werkzeug.urls import url_encode
+
+
+def freeze(obj, exclude=()):
+    """把模型对象的列值复制成普通对象，脱离 session 后仍可在模板中安全使用。"""
+    if obj is None:
+        return None
+    return SimpleNamespace(**{column.key: getattr(obj, column.key)
+                              for column in obj.__table__.columns if column.key not in exclude})
+
+
+class Generations(object):
+    """保存在缓存目录中的版本戳，所有 worker 进程共享。
+
+    写操作调用 bump() 生成新的版本戳，读取方比较版本戳是否变化来决定是否重新加载数据。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        path = os.path.join(app.config['BREAKBLOG_CACHE_PATH'], 'generations')
+        os.makedirs(path, exist_ok=True)
+        app.extensions['breakblog_generations'] = path
+
+    def _path(self, name):
+        return os.path.join(current_app.extensions['breakblog_generations'], name.replace(':', '-'))
+
+    def get(self, name):
+        try:
+            with open(self._path(name)) as f:
+                return f.read()
+        except (IOError, OSError):  # 还没有写入过版本戳
+            return ''
+
+    def bump(self, *names):
+        for name in names:
+            path = self._path(name)
+            stamp = uuid.uuid4().hex
+            tmp_path = '%s.%s' % (path, stamp)
+            with open(tmp_path, 'w') as f:
+                f.write(stamp)
+            os.replace(tmp_path, path)  # 原子替换，读取方不会读到写了一半的文件
+
+
+generations = Generations()
+
+
+class SiteContext(object):
+    """缓存模板全局上下文。
+
+    管理员信息、分类和链接依赖 'site' 版本戳，待审核评论数量依赖 'comments' 版本戳。
+    每个 worker 只在对应的版本戳变化后才重新查询数据库，其余时候直接使用内存中的数据。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['breakblog_site_context'] = {
+            'site': (None, None), 'comments': (None, None), 'lock': threading.Lock()}
+
+    def _get(self, name, loader):
+        state = current_app.extensions['breakblog_site_context']
+        # 先读取版本戳再加载数据，加载期间如果版本戳又变化，下一次请求会重新加载
+        generation = generations.get(name)
+        if state[name][0] != generation or state[name][1] is None:
+            with state['lock']:
+                if state[name][0] != generation or state[name][1] is None:
+                    state[name] = (generation, loader())
+        return state[name][1]
+
+    def get(self):
+        context = dict(self._get('site', self._load_site))
+        context['unread_comments'] = self._get('comments', self._load_unread_comments)
+        return context
+
+    def invalidate(self):
+        generations.bump('site')
+
+    def invalidate_comments(self):
+        generations.bump('comments')
+
+    @staticmethod
+    def _load_site():
+        from breakblog.models import Admin, Category, Link
+
+        post_counts = Category.post_counts()
+        categories = []
+        for category in Category.query.order_by(Category.name).all():
+            category = freeze(category)
+            category.post_count = post_counts.get(category.id, 0)
+            categories.append(category)
+        return dict(
+            admin=freeze(Admin.query.first(), exclude=('password_hash',)),
+            categories=categories,
+            links=[freeze(link) for link in Link.query.order_by(Link.name).all()])
+
+    @staticmethod
+    def _load_unread_comments():
+        from breakblog.models import Comment
+
+        return Comment.query.filter_by(reviewed=False).count()
+
+
+site_context = SiteContext()
+
+
+class AdminPrincipal(UserMixin):
+    """登录管理员的只读副本（不包含密码散列），不绑定数据库 session，可以在请求之间共享。"""
+
+    def __init__(self, admin):
+        for column in admin.__table__.columns:
+            if column.key != 'password_hash':
+                setattr(self, column.key, getattr(admin, column.key))
+
+
+class Principals(object):
+    """缓存已登录的管理员，供 login_manager.user_loader 使用。
+
+    session 中保存加载管理员时的 'admin' 版本戳和密码散列的指纹。版本戳没有变化时直接返回内存中的
+    AdminPrincipal，不查询数据库；修改设置或密码后版本戳变化，下一次请求重新查询。
+    密码散列与 session 中的指纹不一致时（密码已修改）返回 None，其他已登录的 session 随之失效。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['breakblog_principals'] = {'entry': (None, None), 'lock': threading.Lock()}
+
+    def load(self, user_id):
+        from breakblog.models import Admin
+
+        state = current_app.extensions['breakblog_principals']
+        generation = generations.get('admin')
+        cached_generation, principal = state['entry']
+        if session.get('_admin_generation') == generation and cached_generation == generation \
+                and principal is not None and principal.get_id() == user_id:
+            return principal
+
+        admin = Admin.query.get(int(user_id))
+        if admin is None:
+            return None
+        credential = self.credential(admin)
+        # 通过“记住我”的 cookie 登录时 session 中还没有指纹
+        if session.get('_admin_credential', credential) != credential:
+            return None
+        principal = AdminPrincipal(admin)
+        with state['lock']:
+            state['entry'] = (generation, principal)
+        self.remember(admin, generation, credential)
+        return principal
+
+    def remember(self, admin, generation=None, credential=None):
+        """登录后调用，在 session 中记录版本戳和密码散列的指纹。"""
+        session['_admin_generation'] = generations.get('admin') if generation is None else generation
+        session['_admin_credential'] = credential or self.credential(admin)
+
+    @staticmethod
+    def credential(admin):
+        return hashlib.sha256((admin.password_hash or '').encode('utf-8')).hexdigest()[:16]
+
+    def invalidate(self):
+        generations.bump('admin')
+
+
+principals = Principals()
+
+
+class MemoryCache(object):
+    """进程内的 LRU 缓存，限制条目数量，条目超过 timeout 秒后过期。"""
+
+    def __init__(self, max_entries=1000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)  # 淘汰最久没有使用的条目
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemCache(object):
+    """保存在磁盘上的缓存，同一台服务器上的所有 worker 共享。"""
+
+    def __init__(self, path, max_entries=1000, timeout=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.PickleError):
+            return None
+        if expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value):
+        filename = self._filename(key)
+        tmp_filename = '%s.%s.tmp' % (filename, uuid.uuid4().hex)
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump((time.time() + self.timeout, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        self._writes += 1
+        if self._writes % max(self.max_entries // 10, 1) == 0:
+            self._prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def _prune(self):
+        # 文件数量超过上限时，按修改时间删除最旧的文件
+        entries = []
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                entries.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime, filename in entries[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+class PageCache(object):
+    """匿名访客的整页缓存。
+
+    缓存键由端点、视图参数和查询字符串组成。每个条目记录渲染前各依赖标签的版本戳，
+    读取时版本戳不一致即视为失效，所以后台修改只需 bump 受影响的标签，所有 worker 同时生效。
+    已登录用户和带有闪现消息的请求不使用缓存。
+    """
+
+    csrf_placeholder = '\x00csrf-token\x00'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['BREAKBLOG_PAGE_CACHE']
+        max_entries = app.config['BREAKBLOG_PAGE_CACHE_MAX_ENTRIES']
+        timeout = app.config['BREAKBLOG_PAGE_CACHE_TIMEOUT']
+        if backend == 'memory':
+            cache = MemoryCache(max_entries, timeout)
+        elif backend == 'filesystem':
+            cache = FileSystemCache(os.path.join(app.config['BREAKBLOG_CACHE_PATH'], 'pages'), max_entries, timeout)
+        else:
+            cache = None
+        app.extensions['breakblog_page_cache'] = cache
+
+    def cached(self, *tags):
+        """缓存视图的 GET 响应，tags 中可以使用视图参数，例如 'post:{post_id}'。"""
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                cache = current_app.extensions['breakblog_page_cache']
+                if cache is None or request.method != 'GET' or current_user.is_authenticated \
+                        or session.get('_flashes'):
+                    return f(*args, **kwargs)
+
+                key = self._make_key()
+                entry_tags = [tag.format(**kwargs) for tag in tags]
+                stamps = [generations.get(tag) for tag in entry_tags]
+                entry = cache.get(key)
+                if entry is not None and entry['stamps'] == stamps:
+                    return self._make_response(entry, 'HIT')
+
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough \
+                        and not session.get('_flashes') and not get_flashed_messages():
+                    entry = self._make_entry(response, stamps)
+                    cache.set(key, entry)
+                    response.headers['X-Cache'] = 'MISS'
+                return response
+
+            return decorated_function
+
+        return decorator
+
+    def invalidate(self, *tags):
+        generations.bump(*tags)
+
+    def invalidate_post(self, post):
+        # 文章页、首页列表和所属分类页
+        self.invalidate('posts', 'post:%d' % post.id, 'category:%d' % post.category_id)
+
+    def clear(self):
+        cache = current_app.extensions['breakblog_page_cache']
+        if cache is not None:
+            cache.clear()
+
+    @staticmethod
+    def _make_key():
+        view_args = sorted((request.view_args or {}).items())
+        query = url_encode(sorted(request.args.items(multi=True)))
+        # 页面中有包含域名的绝对地址（订阅链接等），不同 Host 的请求不能共用缓存
+        return 'page:%s:%s:%s:%s' % (request.host_url, request.endpoint, view_args, query)
+
+    def _make_entry(self, response, stamps):
+        data = response.get_data(as_text=True)
+        # CSRF 令牌与会话绑定，保存时替换成占位符，返回缓存时再填入当前访客的令牌
+        token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+        has_csrf_token = bool(token) and token in data
+        if has_csrf_token:
+            data = data.replace(token, self.csrf_placeholder)
+        return dict(data=data, mimetype=response.mimetype, stamps=stamps, csrf=has_csrf_token)
+
+    def _make_response(self, entry, status):
+        data = entry['data']
+        if entry['csrf']:
+            data = data.replace(self.csrf_placeholder, generate_csrf())
+        response = current_app.response_class(data, mimetype=entry['mimetype'])
+        response.headers['X-Cache'] = status
+        return response
+
+
+page_cache = PageCache()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import re
+
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase, TextClause
+
+READER = 'reader'  # 只读引擎在 SQLALCHEMY_BINDS 中的名称
+
+# 以字符串或 text() 执行的写操作，例如全文搜索索引的 INSERT / DELETE
+WRITE_STATEMENT = re.compile(r'^\s*(?:INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.I)
+
+
+def _is_write(clause):
+    if isinstance(clause, UpdateBase):  # insert()、update()、delete()
+        return True
+    if isinstance(clause, TextClause):
+        return WRITE_STATEMENT.match(clause.text) is not None
+    return False
+
+
+class RoutingSession(SignallingSession):
+    """session.info['read_only'] 为 True 时，查询使用只读引擎，flush 和写语句仍然使用主库。
+
+    同一个事务中可以先在只读引擎上读取，再在主库上写入，提交时两个连接一起提交。
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('read_only') and not self._flushing and not _is_write(clause):
+            if READER in (self.app.config['SQLALCHEMY_BINDS'] or {}):
+                return get_state(self.app).db.get_engine(self.app, bind=READER)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class SQLAlchemy(_SQLAlchemy):
+    """在 Flask-SQLAlchemy 的基础上增加 SQLite 的连接参数和读写分离。
+
+    BREAKBLOG_SQLITE_PRAGMAS 在每个新的 SQLite 连接上执行；SQLALCHEMY_ENGINE_OPTIONS 设置了 pool_size 时，
+    SQLite 文件数据库使用 QueuePool 复用连接，而不是每次请求重新打开文件。
+    BREAKBLOG_DATABASE_READ_SPLIT 为 True 时注册名为 'reader' 的只读引擎，地址为 BREAKBLOG_DATABASE_READ_URL
+    （例如副本），未设置时与主库相同；SQLite 开启 WAL 后，只读连接上的查询不会被写事务阻塞。
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('BREAKBLOG_SQLITE_PRAGMAS', {})
+        if app.config.get('BREAKBLOG_DATABASE_READ_SPLIT'):
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.setdefault(READER, app.config.get('BREAKBLOG_DATABASE_READ_URL') or
+                             app.config['SQLALCHEMY_DATABASE_URI'])
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super(SQLAlchemy, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        # Flask-SQLAlchemy 在合并 SQLALCHEMY_ENGINE_OPTIONS 之前判断连接池，这里按合并后的 pool_size 重新选择
+        if sa_url.drivername == 'sqlite' and sa_url.database not in (None, '', ':memory:') \
+                and (app.config['SQLALCHEMY_ENGINE_OPTIONS'] or {}).get('pool_size'):
+            options['poolclass'] = QueuePool
+            # 连接由连接池在线程之间传递，同一时间只有一个线程使用
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        pragmas = self.get_app().config['BREAKBLOG_SQLITE_PRAGMAS']
+        if sa_url.drivername == 'sqlite' and pragmas:
+            @event.listens_for(engine, 'connect')
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas.items():
+                    cursor.execute('PRAGMA %s = %s' % (name, value))
+                cursor.close()
+        return engine
@@ -4,26 +4,14 @@
     :github_url: https://github.com/tw-huang
     :email: tw.huang@foxmail.com
 """
-from threading import Thread
-
 from flask import url_for, current_app
-from flask_mail import Message
-
-from breakblog.extensions import mail
-
 
-# p191 使用异步发送电子邮件
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+from breakblog.outbox import outbox
 
 
+# p191 异步发送电子邮件：邮件先写入发件箱，随当前事务提交后由后台发送线程批量发送
 def send_mail(subject, to, html):
-    app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    return outbox.enqueue(subject, to, html)
 
 
 # p251 send_new_comment_email() 文章被游客回复提醒邮件
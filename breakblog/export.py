@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import uuid
+from datetime import datetime
+
+from breakblog.caching import page_cache
+from breakblog.extensions import db
+
+EXPORT_VERSION = 1  # 输出格式或页面结构变化时加一，下一次导出会重新生成所有页面
+MANIFEST = '.export-manifest.json'
+
+# 页码分页生成的链接，例如 /?page=2、/category/3?page=2、/post/5?page=2#comments；
+# Bootstrap-Flask 的 render_pagination 宏生成的地址前面带有换行和缩进
+PAGE_LINK = re.compile(r'href="\s*(?P<path>/(?:category/\d+|post/\d+)?)\?page=(?P<page>\d+)(?P<fragment>#[\w-]*)?"')
+
+_app = None  # 进程池中每个进程自己的应用实例
+
+
+def page_path(base, page):
+    """第 page 页的静态路径：/、/page/2/、/category/3/page/2/、/post/5/page/2/。"""
+    if page == 1:
+        return base
+    return '%s/page/%d/' % (base.rstrip('/'), page)
+
+
+def page_url(base, page):
+    """生成第 page 页时请求的 URL。"""
+    return base if page == 1 else '%s?page=%d' % (base, page)
+
+
+def output_file(output, path):
+    return os.path.join(output, path.strip('/'), 'index.html')
+
+
+def _signature(*values):
+    data = json.dumps(values, default=str, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+def _rewrite_links(html):
+    def replace(match):
+        return 'href="%s%s"' % (page_path(match.group('path'), int(match.group('page'))),
+                                match.group('fragment') or '')
+
+    return PAGE_LINK.sub(replace, html)
+
+
+def _write(path, data):
+    # 先写入临时文件再原子替换，nginx 不会发送写了一半的页面
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _files_fingerprint(*folders):
+    # 模板和静态文件修改后（例如部署新版本）需要重新生成所有页面
+    entries = []
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                entries.append((os.path.relpath(os.path.join(root, name), folder), stat.st_size, int(stat.st_mtime)))
+    return _signature(entries)
+
+
+def site_signature(app):
+    """所有页面共有的内容：博客信息、侧边栏的分类（含文章数量）和链接、模板。"""
+    from breakblog.models import Admin, Category, Link
+
+    admin = Admin.query.first()
+    counts = Category.post_counts()
+    return _signature(
+        EXPORT_VERSION,
+        admin and (admin.blog_title, admin.blog_sub_title, admin.name, admin.about),
+        [(category.id, category.name, counts.get(category.id, 0)) for category in Category.query.order_by(Category.id)],
+        [(link.id, link.name, link.url) for link in Link.query.order_by(Link.id)],
+        _files_fingerprint(os.path.join(app.root_path, app.template_folder), app.static_folder))
+
+
+def collect_pages(app):
+    """返回 {静态路径: (请求的 URL, 签名)}。
+
+    列表页的签名取决于该页文章的 id、修改时间、分类和评论数量，以及总页数；
+    文章页的签名取决于文章的修改时间、分类、是否允许评论和已审核评论的集合（数量和 id 之和）。
+    浏览量不计入签名，静态页面中的浏览量是导出时的数值。
+    """
+    from breakblog.models import Post, Comment, Category
+
+    config = app.config
+    post, comment = Post.__table__, Comment.__table__
+    # 与页码分页相同的排序
+    rows = db.session.execute(db.select([
+        post.c.id, post.c.category_id, post.c.updated_at, post.c.can_comment, post.c.comment_count,
+        post.c.reviewed_comment_count]).order_by(post.c.timestamp.desc(), post.c.id.desc())).fetchall()
+    comment_ids = dict(db.session.execute(
+        db.select([comment.c.post_id, db.func.sum(comment.c.id)]).where(
+            comment.c.reviewed == True).group_by(comment.c.post_id)).fetchall())  # noqa: E712
+
+    pages = {}
+
+    def add_listing(base, items):
+        per_page = config['BREAKBLOG_POST_PER_PAGE']
+        count = max(int(math.ceil(len(items) / float(per_page))), 1)
+        for page in range(1, count + 1):
+            chunk = items[(page - 1) * per_page:page * per_page]
+            pages[page_path(base, page)] = (page_url(base, page), _signature(
+                count, [(row.id, row.updated_at, row.category_id, row.comment_count) for row in chunk]))
+
+    add_listing('/', rows)
+    by_category = {category_id: [] for category_id, in db.session.query(Category.id)}
+    for row in rows:
+        if row.category_id is not None:
+            by_category.setdefault(row.category_id, []).append(row)
+    for category_id, items in by_category.items():
+        add_listing('/category/%d' % category_id, items)
+
+    per_page = config['BREAKBLOG_COMMENT_PER_PAGE']
+    for row in rows:
+        count = max(int(math.ceil(row.reviewed_comment_count / float(per_page))), 1)
+        signature = _signature(count, row.updated_at, row.category_id, row.can_comment,
+                               row.reviewed_comment_count, comment_ids.get(row.id))
+        for page in range(1, count + 1):
+            pages[page_path('/post/%d' % row.id, page)] = (page_url('/post/%d' % row.id, page), signature)
+
+    pages['/about'] = ('/about', '')
+    return pages
+
+
+def prepare_app(app):
+    """修改用于导出的应用实例的配置：页码分页、关闭页面缓存和浏览量计数，不启动发信线程。"""
+    app.config.update(BREAKBLOG_STATIC_EXPORT=True, BREAKBLOG_PAGINATION='offset', BREAKBLOG_PAGE_CACHE=None)
+    page_cache.init_app(app)
+    sender = app.extensions.get('breakblog_outbox')
+    if sender is not None:
+        sender.workers = 0
+
+
+def render_pages(app, output, base_url, tasks):
+    """渲染 [(静态路径, URL)]，返回 [(静态路径, 状态码)]。"""
+    results = []
+    client = app.test_client()
+    for path, url in tasks:
+        response = client.get(url, base_url=base_url)
+        if response.status_code == 200:
+            html = _rewrite_links(response.get_data(as_text=True))
+            _write(output_file(output, path), html.encode('utf-8'))
+        results.append((path, response.status_code))
+    return results
+
+
+def _init_worker(config):
+    global _app
+    from breakblog import create_app
+
+    _app = create_app()
+    _app.config.update(config)
+    prepare_app(_app)
+
+
+def _render_chunk(args):
+    return render_pages(_app, *args)
+
+
+def sync_static(source, target):
+    """把静态文件复制到导出目录，只复制大小或修改时间不同的文件。"""
+    copied = 0
+    for root, dirs, files in os.walk(source):
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target, os.path.relpath(src, source))
+            src_stat = os.stat(src)
+            if os.path.exists(dst):
+                dst_stat = os.stat(dst)
+                if dst_stat.st_size == src_stat.st_size and int(dst_stat.st_mtime) == int(src_stat.st_mtime):
+                    continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(src, dst)
+            copied += 1
+    return copied
+
+
+def _remove(output, path):
+    filename = output_file(output, path)
+    if os.path.exists(filename):
+        os.remove(filename)
+    directory = os.path.dirname(filename)
+    while directory != output and os.path.isdir(directory) and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+
+def _load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):  # 第一次导出或清单损坏，重新生成所有页面
+        return {}
+
+
+def export_site(app, output, workers=1, base_url='http://localhost/', full=False, chunk_size=200, progress=None):
+    """把公开页面导出到 output 目录，返回 (生成的页面数量, 删除的页面数量, 失败的页面列表)。
+
+    与上一次导出的清单比较签名，只重新生成内容变化的页面；站点信息、分类、链接或模板变化时重新生成全部页面。
+    workers 大于 1 时在进程池中渲染，每个进程创建自己的应用实例和数据库连接。
+    """
+    output = os.path.abspath(output)
+    manifest = _load_manifest(output)
+    site = site_signature(app)
+    pages = collect_pages(app)
+    db.session.remove()  # 之后的渲染不需要这里的连接，也避免 fork 出的子进程继承它
+    full = full or manifest.get('version') != EXPORT_VERSION or manifest.get('site') != site
+    old_pages = {} if full else manifest.get('pages', {})
+
+    dirty = sorted(path for path, (url, signature) in pages.items()
+                   if old_pages.get(path) != signature or not os.path.exists(output_file(output, path)))
+    removed = sorted(set(manifest.get('pages', {})) - set(pages))
+    for path in removed:
+        _remove(output, path)
+    if app.static_folder:
+        sync_static(app.static_folder, os.path.join(output, 'static'))
+
+    tasks = [(path, pages[path][0]) for path in dirty]
+    chunks = [(output, base_url, tasks[i:i + chunk_size]) for i in range(0, len(tasks), chunk_size)]
+    rendered = {path: signature for path, signature in old_pages.items() if path in pages}
+    failed = []
+    done = [0]
+
+    def collect(results):
+        for path, status in results:
+            if status == 200:
+                rendered[path] = pages[path][1]
+            else:
+                rendered.pop(path, None)  # 下一次导出时重试
+                failed.append((path, status))
+        done[0] += len(results)
+        if progress is not None:
+            progress(done[0], len(tasks))
+
+    if workers > 1 and len(chunks) > 1:
+        config = dict(SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'],
+                      BREAKBLOG_CACHE_PATH=app.config['BREAKBLOG_CACHE_PATH'])
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(config,))
+        try:
+            for results in pool.imap_unordered(_render_chunk, chunks):
+                collect(results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        prepare_app(app)
+        for chunk in chunks:
+            collect(render_pages(app, *chunk))
+
+    data = json.dumps(dict(version=EXPORT_VERSION, site=site, exported_at=datetime.utcnow().isoformat(),
+                           pages=rendered), sort_keys=True, indent=0)
+    _write(os.path.join(output, MANIFEST), data.encode('utf-8'))
+    return len(dirty) - len(failed), len(removed), failed
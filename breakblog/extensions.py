@@ -11,9 +11,10 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
 
+from breakblog.database import SQLAlchemy
+
 bootstrap = Bootstrap()
 db = SQLAlchemy()
 login_manager = LoginManager()
@@ -28,9 +29,9 @@ migrate = Migrate()
 # p276 获取当前用户
 @login_manager.user_loader  # @login_manager.user_loader装饰器，接收用户id为参数，返回对应的用户对象
 def load_user(user_id):
-    from breakblog.models import Admin
-    user = Admin.query.get(int(user_id))
-    return user
+    from breakblog.caching import principals
+    # 返回缓存的管理员，管理员信息和密码没有变化时不查询数据库
+    return principals.load(user_id)
 
 
 # p280 视图保护
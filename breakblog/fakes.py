@@ -5,6 +5,9 @@
     :email: tw.huang@foxmail.com
 """
 import random
+import time
+from array import array
+from datetime import datetime
 
 from faker import Faker
 
@@ -12,6 +15,7 @@ from sqlalchemy.exc import IntegrityError
 
 from breakblog.models import Admin, Category, Post, Comment, Link
 from breakblog.extensions import db
+from breakblog.rendering import render_post
 
 fake = Faker('zh_CN')  # Faker('zh_CN') 创建中文虚拟数据
 
@@ -56,6 +60,7 @@ def fake_posts(count=50):
                 random.randint(1, Category.query.count())),
             timestamp=fake.date_time_this_year()
         )
+        post.render()
         db.session.add(post)
     db.session.commit()
 
@@ -119,6 +124,9 @@ def fake_comments(count=500):
         db.session.add(comment)
     db.session.commit()
 
+    Post.recount_comments()
+    db.session.commit()
+
 
 def fake_links():
     twitter = Link(name='Twitter', url='#')
@@ -127,3 +135,127 @@ def fake_links():
     google = Link(name='Google+', url='#')
     db.session.add_all([twitter, facebook, linkedin, google])
     db.session.commit()
+
+
+# 批量生成模式：预先确定 id 范围，从预生成的文本池中取值，按块用 executemany 插入，
+# 内存占用只和块大小、文章数量有关，与评论数量无关
+def _pool(make, size):
+    return [make() for i in range(size)]
+
+
+def _insert(table, rows):
+    if rows:
+        db.session.execute(table.insert(), rows)
+        db.session.commit()  # 每块一个事务
+
+
+def bulk_categories(count, rng):
+    names = {'Default'}
+    rows = [dict(id=1, name='Default')]
+    while len(rows) < count + 1:
+        name = fake.word()
+        if name in names:  # 分类名称不能重复
+            name = '%s%d' % (name, len(rows))
+        names.add(name)
+        rows.append(dict(id=len(rows) + 1, name=name))
+    _insert(Category.__table__, rows)
+    return len(rows)
+
+
+def bulk_posts(count, categories, rng, chunk_size=10000, progress=None, days=365):
+    """生成 count 篇文章，时间按 id 顺序分布在最近 days 天内，返回每篇文章的时间戳（下标为文章 id）。"""
+    titles = _pool(fake.sentence, 1000)
+    subtitles = _pool(lambda: fake.text(rng.randint(30, 255)), 500)
+    bodies = _pool(lambda: fake.text(2000), 100)
+    rendered = [render_post(body) for body in bodies]  # 每个正文只生成一次衍生数据
+    end = time.time()
+    start = end - days * 86400
+    step = (end - start) / max(count, 1)
+    timestamps = array('d', [start])
+    rows = []
+    for post_id in range(1, count + 1):
+        timestamp = start + (post_id - 1) * step + rng.random() * step
+        timestamps.append(timestamp)
+        body = rng.randrange(len(bodies))
+        rows.append(dict(
+            id=post_id, title=rng.choice(titles), subtitle=rng.choice(subtitles), body=bodies[body],
+            timestamp=datetime.utcfromtimestamp(timestamp), can_comment=True,
+            pageview=int(rng.paretovariate(1.2) * 10), category_id=rng.randint(1, categories),
+            comment_count=0, reviewed_comment_count=0, **rendered[body]))
+        if len(rows) >= chunk_size:
+            _insert(Post.__table__, rows)
+            if progress is not None:
+                progress(len(rows))
+            rows = []
+    _insert(Post.__table__, rows)
+    if progress is not None:
+        progress(len(rows))
+    return timestamps
+
+
+def bulk_comments(count, timestamps, rng, chunk_size=10000, progress=None):
+    """生成 count 条评论。
+
+    评论集中在较少的热门文章上；同一篇文章的评论时间依次递增（平均间隔 6 小时，不超过当前时间）；
+    约 15% 的评论回复同一篇文章的上一条评论，形成回复链。生成后直接写入文章的评论计数。
+    """
+    posts = len(timestamps) - 1
+    if not posts:
+        return
+    names = _pool(fake.name, 500)
+    emails = _pool(fake.email, 500)
+    sites = _pool(fake.url, 100)
+    sentences = _pool(fake.sentence, 2000)
+    now = time.time()
+    last_timestamp = array('d', timestamps)
+    last_comment = array('l', [0]) * (posts + 1)
+    comment_count = array('l', [0]) * (posts + 1)
+    reviewed_count = array('l', [0]) * (posts + 1)
+
+    rows = []
+    for comment_id in range(1, count + 1):
+        post_id = min(int(posts * rng.random() ** 2) + 1, posts)  # 偏向 id 较小的文章
+        timestamp = min(last_timestamp[post_id] + rng.expovariate(1 / 21600.0), now)
+        last_timestamp[post_id] = timestamp
+        from_admin = rng.random() < 0.05
+        reviewed = from_admin or rng.random() < 0.9
+        replied_id = last_comment[post_id] if last_comment[post_id] and rng.random() < 0.15 else None
+        last_comment[post_id] = comment_id
+        comment_count[post_id] += 1
+        reviewed_count[post_id] += reviewed
+        if from_admin:
+            author, email, site = 'tw.huang', 'tw.huang@foxmail.com', 'http://www.breakblog.me'
+        else:
+            author, email, site = rng.choice(names), rng.choice(emails), rng.choice(sites)
+        rows.append(dict(
+            id=comment_id, author=author, email=email, site=site, body=rng.choice(sentences),
+            from_admin=from_admin, reviewed=reviewed, timestamp=datetime.utcfromtimestamp(timestamp),
+            replied_id=replied_id, post_id=post_id))
+        if len(rows) >= chunk_size:
+            _insert(Comment.__table__, rows)
+            if progress is not None:
+                progress(len(rows))
+            rows = []
+    _insert(Comment.__table__, rows)
+    if progress is not None:
+        progress(len(rows))
+
+    post = Post.__table__
+    statement = post.update().where(post.c.id == db.bindparam('post_id')).values(
+        comment_count=db.bindparam('total'), reviewed_comment_count=db.bindparam('reviewed'))
+    for start in range(1, posts + 1, chunk_size):
+        rows = [dict(post_id=post_id, total=comment_count[post_id], reviewed=reviewed_count[post_id])
+                for post_id in range(start, min(start + chunk_size, posts + 1)) if comment_count[post_id]]
+        if rows:  # 整块文章都没有评论时跳过
+            db.session.execute(statement, rows)
+            db.session.commit()
+
+
+def fake_bulk(category=10, post=50, comment=500, seed=None, chunk_size=10000, progress=None):
+    """批量生成分类、文章和评论，数据表需要为空；seed 相同时生成的数据相同。"""
+    rng = random.Random(seed)
+    if seed is not None:
+        fake.seed_instance(seed)
+    categories = bulk_categories(category, rng)
+    timestamps = bulk_posts(post, categories, rng, chunk_size, progress)
+    bulk_comments(comment, timestamps, rng, chunk_size, progress)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import calendar
+import hashlib
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app, request, render_template
+
+from breakblog.caching import generations, MemoryCache
+from breakblog.extensions import db
+
+FeedEntry = namedtuple('FeedEntry', ['stamps', 'data', 'etag', 'last_modified'])
+
+
+class Feeds(object):
+    """全站和各分类的 Atom 订阅。
+
+    生成的 XML 以字节串保存在进程内，依赖的版本戳（'site'、'posts'、'category:<id>'）变化后才重新查询数据库生成；
+    ETag 由最新文章的时间和 XML 的散列值组成，Last-Modified 为最新文章的发布或编辑时间。
+    阅读器带着 If-None-Match 或 If-Modified-Since 轮询时，只读取版本戳就能返回 304。
+    XML 中是包含域名的绝对地址，每个域名单独缓存，最多保存 BREAKBLOG_FEED_CACHE_MAX_ENTRIES 个，超出时淘汰最久没有使用的。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # 条目在版本戳变化时失效，过期时间只用于释放不再访问的条目
+        app.extensions['breakblog_feeds'] = MemoryCache(app.config['BREAKBLOG_FEED_CACHE_MAX_ENTRIES'], 86400)
+
+    def response(self, name, tags, build):
+        """返回订阅 name 的响应，build() 在缓存失效时生成 (XML 字节串, 最新文章的时间)。"""
+        cache = current_app.extensions['breakblog_feeds']
+        # 先读取版本戳再生成，生成期间如果版本戳又变化，下一次请求会重新生成
+        stamps = [generations.get(tag) for tag in tags]
+        key = (name, request.host_url)
+        entry = cache.get(key)
+        if entry is None or entry.stamps != stamps:
+            data, last_modified = build()
+            digest = hashlib.sha1(data).hexdigest()[:16]
+            timestamp = calendar.timegm(last_modified.utctimetuple()) if last_modified else 0
+            entry = FeedEntry(stamps, data, '%x-%s' % (timestamp, digest), last_modified)
+            cache.set(key, entry)
+
+        response = current_app.response_class(entry.data, mimetype='application/atom+xml')
+        response.set_etag(entry.etag)
+        if entry.last_modified is not None:
+            response.last_modified = entry.last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['BREAKBLOG_FEED_MAX_AGE']
+        return response.make_conditional(request)
+
+    @staticmethod
+    def render(posts, **context):
+        """渲染 Atom XML，返回 (字节串, 最新文章的时间)。"""
+        # 编辑过的文章以编辑时间为准
+        times = [max(post.timestamp, post.updated_at or post.timestamp) for post in posts]
+        last_modified = max(times) if times else None
+        data = render_template('blog/feed.xml', posts=posts, updated=last_modified or datetime.utcnow(), **context)
+        return data.encode('utf-8'), last_modified
+
+    @staticmethod
+    def latest_posts(query):
+        from breakblog.models import Post
+
+        return query.options(db.undefer(Post.body_html), db.joinedload(Post.category)).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(current_app.config['BREAKBLOG_FEED_SIZE']).all()
+
+
+feeds = Feeds()
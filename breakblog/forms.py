@@ -52,6 +52,17 @@ class CategoryForm(FlaskForm):
             raise ValidationError('Name already in use.')
 
 
+# 合并分类表单，把分类中的文章移动到另一个分类后删除该分类
+class MergeCategoryForm(FlaskForm):
+    target = SelectField('Merge into', coerce=int)
+    submit = SubmitField('Merge')
+
+    def __init__(self, category, *args, **kwargs):
+        super(MergeCategoryForm, self).__init__(*args, **kwargs)
+        self.target.choices = [(item.id, item.name) for item in
+                               Category.query.filter(Category.id != category.id).order_by(Category.name).all()]
+
+
 # 评论表单
 class CommentForm(FlaskForm):
     author = StringField('Name', validators=[DataRequired(), Length(1, 30)])
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from flask import current_app, url_for, request, send_file, abort
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 没有安装 Pillow 时只保存原图
+    Image = ImageOps = None
+
+# <sha256>.<ext> 为原图，<sha256>-<宽度>w.<ext> 为缩小的版本，扩展名为 webp 时是对应的 WebP 版本
+IMAGE_FILENAME = re.compile(r'^(?P<digest>[0-9a-f]{64})(?:-(?P<width>\d+)w)?\.(?P<ext>[a-z]+)$')
+
+FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+# Python 3.6 的 mimetypes 还不认识 .webp，否则 WebP 版本会以 application/octet-stream 发送
+mimetypes.add_type('image/webp', '.webp')
+
+
+def normalize_extension(filename):
+    ext = filename.rsplit('.', 1)[1].lower()
+    return 'jpg' if ext == 'jpeg' else ext
+
+
+def variant_filename(digest, ext, width=None):
+    if width is None:
+        return '%s.%s' % (digest, ext)
+    return '%s-%dw.%s' % (digest, width, ext)
+
+
+def _replace(path, write):
+    # 先写入临时文件再原子替换，其他请求不会读到写了一半的图片
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _save(image, path, format):
+    if format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        _replace(path, lambda tmp_path: image.save(tmp_path, format, quality=85, optimize=True, progressive=True))
+    elif format == 'WEBP':
+        _replace(path, lambda tmp_path: image.save(tmp_path, format, quality=80, method=4))
+    else:
+        _replace(path, lambda tmp_path: image.save(tmp_path, format, optimize=True))
+
+
+def make_variants(upload_path, digest, ext, widths):
+    """为原图生成各宽度的缩小版本和 WebP 版本，已经存在的文件不再生成。"""
+    with Image.open(os.path.join(upload_path, variant_filename(digest, ext))) as image:
+        if getattr(image, 'is_animated', False):  # 动图只保留原图
+            return
+        if hasattr(ImageOps, 'exif_transpose'):  # 按照手机照片的 EXIF 方向旋转
+            image = ImageOps.exif_transpose(image)
+        image.load()
+        for width in widths:
+            if width >= image.width:
+                continue
+            height = max(int(round(image.height * width / float(image.width))), 1)
+            resized = image.resize((width, height), Image.LANCZOS)
+            for variant_ext in sorted({ext, 'webp'}):
+                path = os.path.join(upload_path, variant_filename(digest, variant_ext, width))
+                if not os.path.exists(path):
+                    _save(resized, path, FORMATS[variant_ext])
+        path = os.path.join(upload_path, variant_filename(digest, 'webp'))
+        if ext != 'webp' and not os.path.exists(path):
+            _save(image, path, 'WEBP')
+
+
+class ImagePipeline(object):
+    """编辑器上传图片的处理流程。
+
+    原图以内容的 SHA-256 命名保存，相同的图片只保存一份；安装了 Pillow 时，
+    由固定数量的后台线程生成 BREAKBLOG_IMAGE_WIDTHS 中各宽度的缩小版本和 WebP 版本。
+    缩小版本生成之前，请求它的 URL 会得到原图。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        os.makedirs(app.config['BREAKBLOG_UPLOAD_PATH'], exist_ok=True)
+        app.extensions['breakblog_images'] = {'executor': None, 'lock': threading.Lock()}
+
+    @property
+    def enabled(self):
+        return Image is not None and current_app.config['BREAKBLOG_IMAGE_WORKERS'] > 0
+
+    def _executor(self):
+        state = current_app.extensions['breakblog_images']
+        # 线程池在第一次上传时才创建，避免 gunicorn 等预先 fork 的服务器在主进程中启动线程
+        with state['lock']:
+            if state['executor'] is None:
+                state['executor'] = ThreadPoolExecutor(
+                    max_workers=current_app.config['BREAKBLOG_IMAGE_WORKERS'])
+            return state['executor']
+
+    def save(self, storage):
+        """保存上传的文件，返回 (文件名, 宽, 高)，文件不是有效的图片时返回 None。"""
+        ext = normalize_extension(storage.filename)
+        data = storage.read()
+        size = (None, None)
+        if Image is not None:
+            try:
+                with Image.open(BytesIO(data)) as image:
+                    image.verify()
+                    size = image.size
+            except Exception:
+                return None
+        digest = hashlib.sha256(data).hexdigest()
+        upload_path = current_app.config['BREAKBLOG_UPLOAD_PATH']
+        filename = variant_filename(digest, ext)
+        path = os.path.join(upload_path, filename)
+        if not os.path.exists(path):  # 重复上传的图片不再写入
+            def write(tmp_path):
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+
+            _replace(path, write)
+        if self.enabled and ext in FORMATS:
+            future = self._executor().submit(
+                make_variants, upload_path, digest, ext, current_app.config['BREAKBLOG_IMAGE_WIDTHS'])
+            future.add_done_callback(self._log_failure(current_app._get_current_object(), filename))
+        return filename, size[0], size[1]
+
+    @staticmethod
+    def _log_failure(app, filename):
+        def callback(future):
+            if future.exception() is not None:
+                app.logger.error('Failed to generate variants of %s: %r', filename, future.exception())
+
+        return callback
+
+    def size(self, filename):
+        """返回上传图片的 (宽, 高)，文件不存在、不是图片或没有安装 Pillow 时返回 None。"""
+        path = safe_join(current_app.config['BREAKBLOG_UPLOAD_PATH'], filename)
+        if Image is None or path is None or not os.path.isfile(path):
+            return None
+        try:
+            with Image.open(path) as image:
+                return image.size
+        except Exception:
+            return None
+
+    def widths(self, filename, width):
+        """原图宽度为 width 时会生成的缩小版本宽度。"""
+        match = IMAGE_FILENAME.match(filename)
+        if match is None or match.group('width') or not self.enabled or width is None \
+                or match.group('ext') not in FORMATS:
+            return []
+        return [w for w in current_app.config['BREAKBLOG_IMAGE_WIDTHS'] if w < width]
+
+    def srcset(self, filename, width):
+        """img 标签的 srcset 属性值，包括各缩小版本和原图。"""
+        widths = self.widths(filename, width)
+        if not widths:
+            return None
+        match = IMAGE_FILENAME.match(filename)
+        candidates = ['%s %dw' % (url_for('admin.get_image', filename=variant_filename(
+            match.group('digest'), match.group('ext'), w)), w) for w in widths]
+        candidates.append('%s %dw' % (url_for('admin.get_image', filename=filename), width))
+        return ', '.join(candidates)
+
+    def resolve(self, filename, accept_webp=False):
+        """返回实际发送的文件名：优先使用已经生成的 WebP 版本，缩小版本还没生成时退回原图。"""
+        match = IMAGE_FILENAME.match(filename)
+        if match is None:  # 旧版本按原文件名保存的图片
+            return filename
+        upload_path = current_app.config['BREAKBLOG_UPLOAD_PATH']
+        digest, ext = match.group('digest'), match.group('ext')
+        width = int(match.group('width')) if match.group('width') else None
+        candidates = []
+        if accept_webp and ext != 'webp':
+            candidates.append(variant_filename(digest, 'webp', width))
+        candidates.append(filename)
+        if width is not None:
+            candidates.append(variant_filename(digest, ext))
+        for candidate in candidates:
+            if os.path.exists(os.path.join(upload_path, candidate)):
+                return candidate
+        return filename
+
+    def send(self, filename):
+        """发送上传的图片。
+
+        以内容散列值命名的文件永远不会改变，使用一年的 immutable 缓存和基于文件名的强 ETag；
+        缩小版本或 WebP 版本还没生成时发送的原图只缓存一分钟。支持条件请求（304）和 Range 请求。
+        BREAKBLOG_MEDIA_OFFLOAD 为 'x-accel-redirect' 或 'x-sendfile' 时只返回响应头，由 nginx 等服务器发送文件内容。
+        """
+        config = current_app.config
+        accept_webp = 'image/webp' in request.headers.get('Accept', '')
+        resolved = self.resolve(filename, accept_webp)
+        path = safe_join(config['BREAKBLOG_UPLOAD_PATH'], resolved)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        stat = os.stat(path)
+        mimetype = mimetypes.guess_type(resolved)[0] or 'application/octet-stream'
+
+        offload = config['BREAKBLOG_MEDIA_OFFLOAD']
+        if offload == 'x-accel-redirect':
+            response = current_app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = '%s/%s' % (
+                config['BREAKBLOG_MEDIA_ACCEL_PREFIX'].rstrip('/'), resolved)
+        elif offload == 'x-sendfile':
+            response = current_app.response_class(mimetype=mimetype)
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        else:
+            response = send_file(path, mimetype=mimetype, add_etags=False, cache_timeout=0)
+            response.expires = None
+        response.last_modified = int(stat.st_mtime)
+
+        match = IMAGE_FILENAME.match(filename)
+        if match is None:  # 按原文件名保存的图片可能被覆盖，每次使用前都要验证
+            response.set_etag('%x-%x' % (int(stat.st_mtime), stat.st_size))
+            response.headers['Cache-Control'] = 'public, no-cache'
+        else:
+            response.set_etag(resolved)
+            response.vary.add('Accept')  # 浏览器支持 WebP 时发送 WebP 版本
+            if resolved == self._best_match(match, accept_webp):
+                response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+            else:  # 缩小版本或 WebP 版本还没生成，暂时发送原图，例如编辑器在上传后立即预览
+                response.headers['Cache-Control'] = 'public, max-age=60'
+        if offload:  # Range 请求由前端服务器处理
+            response = response.make_conditional(request)
+            del response.headers['Accept-Ranges']
+            return response
+        return response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+
+    def _best_match(self, match, accept_webp):
+        # 所有版本都生成后 resolve() 返回的文件：浏览器支持 WebP 并且会生成 WebP 版本时为同一宽度的 WebP 版本，
+        # 否则为请求的文件本身；动图不生成 WebP 版本，只能使用一分钟的缓存
+        ext = match.group('ext')
+        if accept_webp and ext != 'webp' and ext in FORMATS and self.enabled:
+            width = int(match.group('width')) if match.group('width') else None
+            return variant_filename(match.group('digest'), 'webp', width)
+        return match.group(0)
+
+
+images = ImagePipeline()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import atexit
+import copy
+import hashlib
+import json
+import logging
+import os
+import queue
+import smtplib
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import has_request_context, request
+
+REQUEST_FIELDS = ('method', 'url', 'endpoint', 'remote_addr')
+
+
+def _utc(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def signature(record, exc_info=None):
+    """日志的签名：有异常时为异常类型和抛出异常的位置，否则为记录日志的位置和未格式化的消息。"""
+    if exc_info and exc_info[0] is not None:
+        frames = traceback.extract_tb(exc_info[2])
+        location = '%s:%s' % (frames[-1][0], frames[-1][1]) if frames else ''
+        key = '%s|%s' % (exc_info[0].__name__, location)
+    else:
+        key = '%s:%s|%s' % (record.pathname, record.lineno, record.msg)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+class JSONFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，包含请求信息、异常签名和异常堆栈。"""
+
+    def format(self, record):
+        data = OrderedDict([
+            ('time', datetime.utcfromtimestamp(record.created).isoformat() + 'Z'),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('module', record.module),
+            ('line', record.lineno),
+            ('message', record.getMessage()),
+        ])
+        for field in REQUEST_FIELDS + ('signature',):
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = self.formatException(record.exc_info)
+        if exc_text:
+            data['exception'] = exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LogPipeline(object):
+    """日志队列和在后台线程中写入日志的 QueueListener。
+
+    监听线程在第一条日志时才启动，fork 出的 worker 进程会重新创建自己的队列和线程；
+    队列满时丢弃新日志（dropped 计数），请求线程不会因为磁盘或 SMTP 变慢而阻塞。
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.queue = None
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+        atexit.register(self.stop)  # 进程退出前写完队列中的日志并发送错误汇总
+
+    def put(self, record):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.queue = queue.Queue(self.maxsize)
+                    self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                    self.listener.start()
+                    self.pid = os.getpid()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        with self.lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()  # 处理完队列中剩余的日志
+            self.listener = self.pid = None
+        for handler in self.handlers:
+            handler.close()
+
+
+class QueueLogHandler(QueueHandler):
+    """把日志放入 LogPipeline 的队列。
+
+    请求线程中只合并消息参数、格式化异常堆栈、记录请求信息和签名，写文件和发邮件都在监听线程中进行。
+    """
+
+    def __init__(self, pipeline):
+        super(QueueLogHandler, self).__init__(None)
+        self.pipeline = pipeline
+
+    def enqueue(self, record):
+        self.pipeline.put(record)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.signature = signature(record, record.exc_info)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None  # traceback 对象引用了请求中的局部变量，不放入队列
+        if has_request_context():
+            record.method = request.method
+            record.url = request.url
+            record.endpoint = request.endpoint
+            record.remote_addr = request.remote_addr
+        return record
+
+
+class ErrorDigestHandler(logging.Handler):
+    """按签名合并错误日志，每 interval 秒最多发送一封汇总邮件。
+
+    同一签名在 throttle 秒内只附带一次请求信息和异常堆栈，之后的汇总中只列出发生次数。
+    """
+
+    def __init__(self, mailhost, port, fromaddr, toaddrs, subject, credentials=None, use_tls=False,
+                 use_ssl=False, interval=300, throttle=3600, max_items=20):
+        super(ErrorDigestHandler, self).__init__(logging.ERROR)
+        self.mailhost = mailhost
+        self.port = port
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.interval = interval
+        self.throttle = throttle
+        self.max_items = max_items
+        self.pending = OrderedDict()  # {签名: [次数, 第一条日志, 最后一次的时间]}
+        self.mailed = {}  # {签名: 上一次附带详情发送的时间}
+        self.pending_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def emit(self, record):
+        key = getattr(record, 'signature', None) or signature(record)
+        with self.pending_lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [1, record, record.created]
+            else:
+                entry[0] += 1
+                entry[2] = record.created
+            # 线程在第一条错误时才启动
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='error-digest')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while not self.wakeup.wait(self.interval):
+            self.send_digest()
+
+    def send_digest(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, OrderedDict()
+        if not pending:
+            return
+        try:
+            self.send(*self.digest(pending))
+        except Exception:
+            # 发送失败时只输出到 stderr，不能再记录错误日志，否则会形成循环
+            sys.stderr.write('Failed to send the error digest:\n%s' % traceback.format_exc())
+
+    def digest(self, pending):
+        """生成汇总邮件，返回 (标题, 正文)。"""
+        now = time.time()
+        total = sum(count for count, record, last in pending.values())
+        lines = ['%d errors, %d distinct.' % (total, len(pending)), '']
+        for number, (key, (count, record, last)) in enumerate(pending.items(), 1):
+            if number > self.max_items:
+                lines.append('... and %d more.' % (len(pending) - self.max_items))
+                break
+            summary = (record.getMessage() or '').split('\n')[0]
+            if record.exc_text:  # 异常类型和信息，例如 ZeroDivisionError: division by zero
+                summary = '%s (%s)' % (record.exc_text.splitlines()[-1], summary)
+            else:
+                summary = '%s in %s:%s' % (summary, record.module, record.lineno)
+            lines.append('[%d] %d x %s, signature %s' % (number, count, summary, key))
+            lines.append('    first %s UTC, last %s UTC' % (_utc(record.created), _utc(last)))
+            if now - self.mailed.get(key, 0) < self.throttle:
+                lines.append('    Details were sent at %s UTC.' % _utc(self.mailed[key]))
+            else:
+                self.mailed[key] = now
+                if getattr(record, 'url', None):
+                    lines.append('    %s %s from %s' % (record.method, record.url, record.remote_addr))
+                if record.exc_text:
+                    lines.extend('    ' + line for line in record.exc_text.splitlines())
+            lines.append('')
+        # 删除超过 throttle 的发送记录
+        self.mailed = {key: sent for key, sent in self.mailed.items() if now - sent < self.throttle}
+        return '%s (%d errors)' % (self.subject, total), '\n'.join(lines)
+
+    def send(self, subject, body):
+        message = EmailMessage()
+        message['Subject'] = subject
+        message['From'] = self.fromaddr
+        message['To'] = ', '.join(self.toaddrs)
+        message.set_content(body)
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        with smtp_class(self.mailhost, self.port, timeout=10) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.credentials and self.credentials[0]:
+                smtp.login(*self.credentials)
+            smtp.send_message(message)
+
+    def close(self):
+        self.wakeup.set()
+        self.send_digest()
+        super(ErrorDigestHandler, self).close()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import bisect
+import threading
+import time
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 请求耗时直方图的桶上限（秒），与 Prometheus 客户端的默认值相同
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats(object):
+    __slots__ = ('requests', 'buckets', 'duration', 'queries', 'max_queries', 'db_duration',
+                 'template_duration', 'response_bytes', 'statuses')
+
+    def __init__(self):
+        self.requests = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # 最后一个桶为 +Inf
+        self.duration = 0.0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_duration = 0.0
+        self.template_duration = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+    def quantile(self, q):
+        """根据直方图估算分位数，返回所在桶的上限（秒），落在 +Inf 桶时返回 None。"""
+        if not self.requests:
+            return 0.0
+        rank = q * self.requests
+        seen = 0
+        for upper, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return upper
+        return None
+
+
+class MetricsRegistry(object):
+    """进程内按端点汇总的请求指标，每个请求结束时在锁内累加一次。
+
+    每个 worker 进程分别统计，Prometheus 每次抓取只会得到处理该请求的 worker 的数据。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.started = time.time()
+
+    def record(self, endpoint, status, duration, queries, db_duration, template_duration, response_bytes):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.requests += 1
+            stats.buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+            stats.duration += duration
+            stats.queries += queries
+            stats.max_queries = max(stats.max_queries, queries)
+            stats.db_duration += db_duration
+            stats.template_duration += template_duration
+            stats.response_bytes += response_bytes
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for endpoint, stats in self.endpoints.items():
+                copy = EndpointStats()
+                for name in EndpointStats.__slots__:
+                    value = getattr(stats, name)
+                    setattr(copy, name, value.copy() if isinstance(value, (list, dict)) else value)
+                snapshot[endpoint] = copy
+            return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.started = time.time()
+
+    def prometheus(self):
+        """以 Prometheus 文本格式输出所有指标。"""
+        lines = []
+        snapshot = sorted(self.snapshot().items())
+
+        def family(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        family('breakblog_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+        for endpoint, stats in snapshot:
+            label = _escape_label(endpoint)
+            cumulative = 0
+            for upper, count in zip(BUCKETS + ('+Inf',), stats.buckets):
+                cumulative += count
+                lines.append('breakblog_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                             % (label, upper, cumulative))
+            lines.append('breakblog_request_duration_seconds_sum{endpoint="%s"} %.6f' % (label, stats.duration))
+            lines.append('breakblog_request_duration_seconds_count{endpoint="%s"} %d' % (label, stats.requests))
+
+        family('breakblog_responses_total', 'counter', 'Responses by endpoint and status code.')
+        for endpoint, stats in snapshot:
+            for status, count in sorted(stats.statuses.items()):
+                lines.append('breakblog_responses_total{endpoint="%s",status="%d"} %d'
+                             % (_escape_label(endpoint), status, count))
+
+        for name, attribute, kind, help in (
+                ('breakblog_db_queries_total', 'queries', 'counter', 'SQL statements executed.'),
+                ('breakblog_db_queries_max', 'max_queries', 'gauge', 'Most SQL statements in a single request.'),
+                ('breakblog_db_duration_seconds_total', 'db_duration', 'counter', 'Time spent executing SQL.'),
+                ('breakblog_template_duration_seconds_total', 'template_duration', 'counter',
+                 'Time spent rendering templates.'),
+                ('breakblog_response_bytes_total', 'response_bytes', 'counter', 'Response body bytes sent.')):
+            family(name, kind, help)
+            for endpoint, stats in snapshot:
+                value = getattr(stats, attribute)
+                lines.append('%s{endpoint="%s"} %s' % (
+                    name, _escape_label(endpoint), ('%.6f' % value) if isinstance(value, float) else value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _request_metrics():
+    # 只统计请求上下文中执行的查询和模板，命令行和后台线程中的操作不计入
+    if has_request_context():
+        return g.get('_breakblog_metrics')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('breakblog_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('breakblog_query_start')
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    current = _request_metrics()
+    if current is not None:
+        current['queries'] += 1
+        current['db'] += duration
+
+
+def _before_render_template(app, template, context, **extra):
+    current = _request_metrics()
+    if current is not None:
+        current['template_start'].append(time.perf_counter())
+
+
+def _template_rendered(app, template, context, **extra):
+    current = _request_metrics()
+    if current is not None and current['template_start']:
+        duration = time.perf_counter() - current['template_start'].pop()
+        if not current['template_start']:  # 嵌套渲染时只计算最外层的耗时
+            current['template'] += duration
+
+
+class Metrics(object):
+    """记录每个请求的耗时、SQL 查询数量和耗时、模板渲染耗时和响应大小。
+
+    数据按端点汇总在进程内，通过 Server-Timing 响应头、/admin/metrics 页面和
+    Prometheus 文本格式的 /admin/metrics/prometheus 查看。BREAKBLOG_METRICS 为 False 时关闭。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['BREAKBLOG_METRICS']:
+            app.extensions['breakblog_metrics'] = None
+            return
+        registry = app.extensions['breakblog_metrics'] = MetricsRegistry()
+        server_timing = app.config['BREAKBLOG_SERVER_TIMING']
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+
+        @app.before_request
+        def start_metrics():
+            g._breakblog_metrics = dict(
+                start=time.perf_counter(), queries=0, db=0.0, template=0.0, template_start=[])
+
+        @app.after_request
+        def record_metrics(response):
+            current = g.pop('_breakblog_metrics', None)
+            if current is None:  # 在 before_request 之前就已经返回的响应
+                return response
+            duration = time.perf_counter() - current['start']
+            size = 0 if response.direct_passthrough else (response.calculate_content_length() or 0)
+            registry.record(request.endpoint or '<unmatched>', response.status_code, duration,
+                            current['queries'], current['db'], current['template'], size)
+            if server_timing:
+                response.headers.add(
+                    'Server-Timing', 'db;dur=%.2f;desc="%d queries", tpl;dur=%.2f, app;dur=%.2f'
+                    % (current['db'] * 1000, current['queries'], current['template'] * 1000, duration * 1000))
+            return response
+
+
+metrics = Metrics()
@@ -4,12 +4,15 @@
     :github_url: https://github.com/tw-huang
     :email: tw.huang@foxmail.com
 """
+import json
 from datetime import datetime
 
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from breakblog.extensions import db
+from breakblog.caching import site_context
+from breakblog.rendering import render_post
 # p276 UserMixin表示通过认证的用户，属性is_authenticated、is_active返回True
 
 
@@ -38,23 +41,47 @@ class Category(db.Model):
     posts = db.relationship('Post', back_populates='category')
 
     def delete(self):
-        default_category = Category.query.get(1)  # 获取默认分类评论
-        posts = self.posts[:]
-        for post in posts:
-            post.category = default_category
-        db.session.delete(self)
+        self.merge_into(Category.query.get(1))  # 文章移动到默认分类
+
+    def merge_into(self, target):
+        # 用一条 UPDATE 语句移动所有文章，再删除分类，不把文章加载到 session 中
+        post = Post.__table__
+        db.session.execute(post.update().where(post.c.category_id == self.id).values(category_id=target.id))
+        # 直接删除，避免 ORM 为了解除 posts 关系而查询文章
+        db.session.execute(Category.__table__.delete().where(Category.__table__.c.id == self.id))
+        db.session.expunge(self)
         db.session.commit()
+        site_context.invalidate()  # 侧边栏的分类和文章数量变化，所有页面重新生成
+
+    # 一次分组聚合查询出所有分类的文章数量，返回 {category_id: count}
+    @staticmethod
+    def post_counts():
+        return dict(db.session.query(Post.category_id, db.func.count(Post.id)).group_by(Post.category_id))
 
 
 class Post(db.Model):
+    # 分类页按 category_id 过滤、按 timestamp 排序，SQLite 的索引末尾隐含 rowid（即 id）
+    __table_args__ = (db.Index('ix_post_category_id_timestamp', 'category_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(30))
     subtitle = db.Column(db.Text)  # 自定义文章副标题
-    body = db.Column(db.Text)
+    # 正文和过滤后的 HTML 只在文章页使用，列表查询中延迟加载
+    body = db.deferred(db.Column(db.Text))
+    # 保存文章时由 render() 生成，模板只读取这些字段
+    body_html = db.deferred(db.Column(db.Text))
+    excerpt = db.Column(db.Text)
+    word_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reading_time = db.Column(db.Integer, default=1, server_default='1', nullable=False)  # 分钟
+    toc = db.Column(db.Text)  # 目录，JSON 格式的 [{level, id, text}]
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # 最后一次编辑的时间
     # p292 can_comment 字段储存是否可用评论的布尔值
     can_comment = db.Column(db.Boolean, default=True)
     pageview = db.Column(db.Integer, default=0)  # 新加文章点击量字段
+    # 冗余的评论计数，列表页直接读取，不必加载 post.comments
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reviewed_comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
 
@@ -62,8 +89,56 @@ class Post(db.Model):
     comments = db.relationship(
         'Comment', back_populates='post', cascade='all, delete-orphan')
 
+    def render(self):
+        """根据正文重新生成过滤后的 HTML、摘要、字数、阅读时间和目录，正文修改后调用。"""
+        for name, value in render_post(self.body).items():
+            setattr(self, name, value)
+
+    @property
+    def toc_entries(self):
+        return json.loads(self.toc) if self.toc else []
+
+    def rendered(self):
+        """模板使用的渲染结果。
+
+        还没有执行 flask render-posts 回填的旧文章只在内存中渲染，不修改文章对象，读请求中不会因为 autoflush 向主库写入。
+        """
+        if self.body_html is not None:
+            return dict(body_html=self.body_html, excerpt=self.excerpt, word_count=self.word_count,
+                        reading_time=self.reading_time, toc_entries=self.toc_entries)
+        values = render_post(self.body)
+        values['toc_entries'] = json.loads(values.pop('toc'))
+        return values
+
+    # 用一条 UPDATE 语句根据评论表重新计算评论数量，post_ids 为 None 时重新计算所有文章
+    @staticmethod
+    def recount_comments(post_ids=None):
+        post = Post.__table__
+        comment = Comment.__table__
+        total = db.select([db.func.count(comment.c.id)]).where(
+            comment.c.post_id == post.c.id).as_scalar()
+        reviewed = db.select([db.func.count(comment.c.id)]).where(
+            db.and_(comment.c.post_id == post.c.id, comment.c.reviewed == True)).as_scalar()  # noqa: E712
+        statement = post.update().values(comment_count=total, reviewed_comment_count=reviewed)
+        if post_ids is not None:
+            statement = statement.where(post.c.id.in_(post_ids))
+        db.session.execute(statement)
+
+
+# 单个分类的文章数量，访问时才执行一次 COUNT 查询，避免加载 category.posts 中的全部文章
+Category.post_count = db.column_property(
+    db.select([db.func.count(Post.id)]).where(Post.category_id == Category.id).correlate_except(Post),
+    deferred=True)
+
 
 class Comment(db.Model):
+    __table_args__ = (
+        # 文章页的已审核评论、后台的待审核和管理员评论列表，都按 timestamp 排序
+        db.Index('ix_comment_post_id_reviewed_timestamp', 'post_id', 'reviewed', 'timestamp'),
+        db.Index('ix_comment_reviewed_timestamp', 'reviewed', 'timestamp'),
+        db.Index('ix_comment_from_admin_timestamp', 'from_admin', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(30))
     email = db.Column(db.String(254))
@@ -73,7 +148,7 @@ class Comment(db.Model):
     reviewed = db.Column(db.Boolean, default=False)  # p235 判断是否通过审核
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
 
     post = db.relationship('Post', back_populates='comments')
@@ -83,6 +158,75 @@ class Comment(db.Model):
     replied = db.relationship(
         'Comment', back_populates='replies', remote_side=[id])
 
+    # 一次查询出文章的所有已审核评论，在内存中组织成回复树
+    # 返回 (顶层评论列表, {评论 id: 回复列表})，父评论未通过审核的回复作为顶层评论显示
+    @staticmethod
+    def thread(post):
+        comments = Comment.query.with_parent(post).filter_by(reviewed=True).order_by(
+            Comment.timestamp.asc(), Comment.id.asc()).all()
+        ids = {comment.id for comment in comments}
+        roots, replies = [], {}
+        for comment in comments:
+            if comment.replied_id in ids:
+                replies.setdefault(comment.replied_id, []).append(comment)
+            else:
+                roots.append(comment)
+        return roots, replies
+
+    # 批量审核和删除：criteria 为评论表的过滤条件，直接执行 UPDATE / DELETE，不加载评论对象
+    # 返回 (处理的评论数量, 受影响文章的 [(id, category_id)])，调用者负责提交事务和清除页面缓存
+    @staticmethod
+    def bulk_approve(criteria):
+        comment = Comment.__table__
+        condition = db.and_(comment.c.reviewed == False, *criteria)  # noqa: E712
+        posts = Comment._affected_posts(db.select([comment.c.post_id]).where(condition))
+        result = db.session.execute(comment.update().where(condition).values(reviewed=True))
+        Comment._recount(posts)
+        return result.rowcount, posts
+
+    @staticmethod
+    def bulk_delete(criteria):
+        # 与 replies 关系的 delete-orphan 级联相同，删除选中评论和它们的所有回复；
+        # 用递归 CTE 在数据库中展开回复树
+        comment = Comment.__table__
+        tree = db.select([comment.c.id, comment.c.post_id]).where(db.and_(*criteria)).cte('tree', recursive=True)
+        tree = tree.union(db.select([comment.c.id, comment.c.post_id]).where(comment.c.replied_id == tree.c.id))
+        posts = Comment._affected_posts(db.select([tree.c.post_id]))
+        result = db.session.execute(comment.delete().where(comment.c.id.in_(db.select([tree.c.id]))))
+        Comment._recount(posts)
+        return result.rowcount, posts
+
+    @staticmethod
+    def _affected_posts(post_ids):
+        post = Post.__table__
+        return db.session.execute(db.select([post.c.id, post.c.category_id]).where(
+            post.c.id.in_(post_ids))).fetchall()
+
+    @staticmethod
+    def _recount(posts, chunk_size=500):
+        # 分块传入 id，避免超出 SQLite 的参数数量限制
+        post_ids = [post_id for post_id, category_id in posts]
+        for start in range(0, len(post_ids), chunk_size):
+            Post.recount_comments(post_ids[start:start + chunk_size])
+
+
+# 待发送的邮件，由 breakblog.outbox 中的后台线程或 flask mail-worker 批量发送
+# status: pending 等待发送，sending 已被某个发送者领取，dead 超过重试次数；发送成功后删除
+class OutboxMessage(db.Model):
+    __table_args__ = (db.Index('ix_outbox_message_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    recipient = db.Column(db.String(254))
+    html = db.Column(db.Text)
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_error = db.Column(db.Text)
+    claimed_by = db.Column(db.String(32))  # 领取这条邮件的发送批次
+    claimed_at = db.Column(db.DateTime)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
 
 class Link(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import event
+
+from breakblog.extensions import db, mail
+
+
+def drain(app, batch_size=None):
+    """领取并发送一批到期的邮件，返回本批处理的邮件数量。
+
+    领取通过一条 UPDATE 把邮件标记为 sending 并写入批次号，多个线程或进程同时发送时不会重复领取；
+    领取超过 BREAKBLOG_MAIL_CLAIM_TIMEOUT 秒仍未完成的邮件（发送者崩溃）会被重新领取。
+    同一批邮件复用一个 SMTP 连接，发送失败的邮件按指数退避重试，超过最大次数后标记为 dead。
+    """
+    from breakblog.models import OutboxMessage
+
+    config = app.config
+    outbox = OutboxMessage.__table__
+    batch_size = batch_size or config['BREAKBLOG_MAIL_BATCH_SIZE']
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=config['BREAKBLOG_MAIL_CLAIM_TIMEOUT'])
+
+    due = db.select([outbox.c.id]).where(db.or_(
+        db.and_(outbox.c.status == 'pending', outbox.c.next_attempt_at <= now),
+        db.and_(outbox.c.status == 'sending', outbox.c.claimed_at < stale),
+    )).order_by(outbox.c.id).limit(batch_size)
+    with db.engine.begin() as connection:
+        connection.execute(outbox.update().where(outbox.c.id.in_(due)).values(
+            status='sending', claimed_by=token, claimed_at=now))
+        messages = connection.execute(
+            db.select([outbox]).where(outbox.c.claimed_by == token).order_by(outbox.c.id)).fetchall()
+    if not messages:
+        return 0
+
+    sent, failed = [], []
+    try:
+        with mail.connect() as smtp:
+            for message in messages:
+                try:
+                    smtp.send(Message(message.subject, recipients=[message.recipient], html=message.html))
+                except Exception as e:
+                    failed.append((message, e))
+                else:
+                    sent.append(message.id)
+    except Exception as e:  # 连接 SMTP 服务器失败，本批中还没有发送的邮件全部按失败处理
+        done = set(sent) | {message.id for message, error in failed}
+        failed.extend((message, e) for message in messages if message.id not in done)
+
+    with db.engine.begin() as connection:
+        if sent:
+            connection.execute(outbox.delete().where(outbox.c.id.in_(sent)))
+        if failed:
+            connection.execute(
+                outbox.update().where(outbox.c.id == db.bindparam('message_id')).values(
+                    status=db.bindparam('new_status'), attempts=db.bindparam('new_attempts'),
+                    next_attempt_at=db.bindparam('new_next_attempt_at'), last_error=db.bindparam('error'),
+                    claimed_by=None, claimed_at=None),
+                [_retry(config, message, error) for message, error in failed])
+    for message, error in failed:
+        app.logger.warning('Failed to send mail %d to %s (attempt %d): %s',
+                           message.id, message.recipient, message.attempts + 1, error)
+    return len(messages)
+
+
+def _retry(config, message, error):
+    attempts = message.attempts + 1
+    delay = config['BREAKBLOG_MAIL_RETRY_DELAY'] * 2 ** (attempts - 1)
+    return dict(
+        message_id=message.id,
+        new_status='dead' if attempts >= config['BREAKBLOG_MAIL_MAX_ATTEMPTS'] else 'pending',
+        new_attempts=attempts,
+        new_next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+        error='%s: %s' % (type(error).__name__, error))
+
+
+def drain_all(app):
+    """循环发送直到没有到期的邮件，返回处理的邮件数量。"""
+    total = 0
+    while True:
+        count = drain(app)
+        total += count
+        if count < app.config['BREAKBLOG_MAIL_BATCH_SIZE']:
+            return total
+
+
+class MailSender(object):
+    """固定数量的后台发送线程。
+
+    线程平时每隔 BREAKBLOG_MAIL_POLL_INTERVAL 秒检查一次发件箱，有新邮件提交后立即被唤醒。
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self.interval = app.config['BREAKBLOG_MAIL_POLL_INTERVAL']
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        # 线程在第一次请求或第一封邮件时才启动，避免 gunicorn 等预先 fork 的服务器在主进程中启动线程
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            for i in range(len(self.threads), self.workers):
+                thread = threading.Thread(target=self._run, name='mail-sender-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def notify(self):
+        self.start()
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    drain_all(self.app)
+                except Exception:
+                    self.app.logger.exception('Failed to drain the mail outbox.')
+                finally:
+                    db.session.remove()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+
+class Outbox(object):
+    """邮件发件箱。
+
+    enqueue() 只把邮件加入当前数据库会话，和业务数据在同一个事务中提交，进程重启也不会丢失；
+    提交后唤醒本进程的发送线程。BREAKBLOG_MAIL_WORKERS 为 0 时不启动发送线程，
+    由单独运行的 `flask mail-worker` 进程发送。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        workers = app.config['BREAKBLOG_MAIL_WORKERS']
+        sender = MailSender(app, workers) if workers > 0 else None
+        app.extensions['breakblog_outbox'] = sender
+        if sender is not None:
+            app.before_first_request(sender.start)  # 发送上次进程退出前未发送的邮件
+
+    def enqueue(self, subject, to, html):
+        from breakblog.models import OutboxMessage
+
+        message = OutboxMessage(subject=subject, recipient=to, html=html)
+        db.session.add(message)
+        db.session.info['breakblog_outbox'] = True
+        return message
+
+
+outbox = Outbox()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _notify_sender(session):
+    if session.info.pop('breakblog_outbox', False):
+        sender = current_app.extensions.get('breakblog_outbox')
+        if sender is not None:
+            sender.notify()
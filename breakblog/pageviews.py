@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import atexit
+import threading
+from collections import Counter
+from functools import wraps
+
+from flask import current_app
+
+from breakblog.extensions import db
+
+
+class PageviewBuffer(object):
+    """在内存中按文章 id 累加浏览量，由后台线程定时或达到阈值时批量写入数据库。"""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['BREAKBLOG_PAGEVIEW_FLUSH_INTERVAL']
+        self.threshold = app.config['BREAKBLOG_PAGEVIEW_FLUSH_THRESHOLD']
+        self.counts = Counter()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        atexit.register(self.flush)  # 进程退出前写入剩余的浏览量
+
+    def add(self, post_id, increment=1):
+        with self.lock:
+            self.counts[post_id] += increment
+            self.pending += increment
+            # 线程在第一次使用时才启动，避免 gunicorn 等预先 fork 的服务器在主进程中启动线程
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='pageview-flusher')
+                self.thread.daemon = True
+                self.thread.start()
+            if self.pending >= self.threshold:
+                self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+            self.pending = 0
+        if not counts:
+            return
+        with self.app.app_context():
+            try:
+                # 不使用 db.session，避免影响同一线程中正在处理的请求
+                with db.engine.begin() as connection:
+                    connection.execute(*pageview_update(counts))
+            except Exception:
+                # 写入失败时把计数放回缓冲区，等待下一次写入
+                with self.lock:
+                    self.counts.update(counts)
+                    self.pending += sum(counts.values())
+                self.app.logger.exception('Failed to flush %d pageviews.', sum(counts.values()))
+
+
+def pageview_update(counts):
+    """根据 {post_id: 增量} 生成一条 executemany 的 UPDATE ... SET pageview = pageview + :increment。"""
+    from breakblog.models import Post
+
+    post = Post.__table__
+    statement = post.update().where(post.c.id == db.bindparam('post_id')).values(
+        pageview=db.func.coalesce(post.c.pageview, 0) + db.bindparam('increment'))
+    return statement, [dict(post_id=post_id, increment=increment) for post_id, increment in counts.items()]
+
+
+class Pageviews(object):
+    """文章浏览量计数。
+
+    BREAKBLOG_PAGEVIEW_MODE 为 'immediate' 时每次浏览立即执行一条原子的 UPDATE；
+    为 'buffered' 时交给 PageviewBuffer 批量写入，读请求不再需要写事务。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['BREAKBLOG_PAGEVIEW_MODE'] == 'buffered':
+            app.extensions['breakblog_pageviews'] = PageviewBuffer(app)
+        else:
+            app.extensions['breakblog_pageviews'] = None
+
+    def hit(self, post_id):
+        buffer = current_app.extensions['breakblog_pageviews']
+        if buffer is None:
+            db.session.execute(*pageview_update({post_id: 1}))
+            db.session.commit()
+        else:
+            buffer.add(post_id)
+
+    def flush(self):
+        buffer = current_app.extensions['breakblog_pageviews']
+        if buffer is not None:
+            buffer.flush()
+
+    def counted(self, f):
+        """视图每处理一次请求，post_id 参数对应文章的浏览量+1，放在页面缓存装饰器外层，命中缓存时也会计数。"""
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not current_app.config['BREAKBLOG_STATIC_EXPORT']:  # flask export 生成静态页面时不计数
+                self.hit(kwargs['post_id'])
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+
+pageviews = Pageviews()
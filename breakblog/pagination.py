@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import math
+import time
+from datetime import datetime
+
+from flask import current_app, request, url_for
+from itsdangerous import URLSafeSerializer, BadData
+from sqlalchemy import and_, or_
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='breakblog-cursor')
+
+
+class KeysetPagination(object):
+    """基于 (timestamp, id) 的游标分页。
+
+    翻页时用上一页最后一条记录的 (timestamp, id) 作为条件，通过 timestamp 索引直接定位，
+    不需要 COUNT(*) 和 OFFSET，越往后翻查询代价也不会增加。
+    游标是签名后的字符串，记录位置、方向和当前页之前的记录数量（用于显示页码和序号）。
+    """
+
+    def __init__(self, query, model, per_page, cursor=None, descending=True, total=None):
+        self.model = model
+        self.per_page = per_page
+        self.descending = descending
+        self.total = total
+
+        key, direction, offset = self._load_cursor(cursor)
+        if direction == 'last' and self.total is None:
+            self.total = query.order_by(None).count()
+        backwards = direction in ('prev', 'last')
+
+        query = query.order_by(None)
+        if key is not None:
+            query = query.filter(self._after(key, backwards))
+        items = query.order_by(*self._ordering(backwards)).limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+        self.items = items
+
+        if direction == 'next':
+            self.has_prev, self.has_next = True, more
+        elif direction == 'prev':
+            self.has_prev, self.has_next = more, True
+        elif direction == 'last':
+            self.has_prev, self.has_next = more, False
+            offset = self.total - len(items)
+        else:
+            self.has_prev, self.has_next = False, more
+        self.offset = max(offset, 0) if self.has_prev else 0
+
+    @property
+    def page(self):
+        return self.offset // self.per_page + 1
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return int(math.ceil(self.total / float(self.per_page)))
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return self._dump_cursor(self.items[0], 'prev', self.offset - self.per_page)
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return self._dump_cursor(self.items[-1], 'next', self.offset + len(self.items))
+
+    def url(self, cursor=None):
+        """生成当前视图指定游标的 URL，保留其他查询参数；cursor 为 'last' 时跳转到最后一页。"""
+        args = dict(request.view_args or {})
+        args.update((key, value) for key, value in request.args.items() if key not in ('cursor', 'page'))
+        if cursor is not None:
+            args['cursor'] = cursor
+        return url_for(request.endpoint, **args)
+
+    def _ordering(self, backwards):
+        if self.descending != backwards:
+            return self.model.timestamp.desc(), self.model.id.desc()
+        return self.model.timestamp.asc(), self.model.id.asc()
+
+    def _after(self, key, backwards):
+        timestamp, id = key
+        column_timestamp, column_id = self.model.timestamp, self.model.id
+        if self.descending != backwards:
+            return or_(column_timestamp < timestamp, and_(column_timestamp == timestamp, column_id < id))
+        return or_(column_timestamp > timestamp, and_(column_timestamp == timestamp, column_id > id))
+
+    @staticmethod
+    def _dump_cursor(item, direction, offset):
+        return _serializer().dumps([item.timestamp.strftime(TIMESTAMP_FORMAT), item.id, direction, offset])
+
+    @staticmethod
+    def _load_cursor(cursor):
+        if cursor == 'last':
+            return None, 'last', 0
+        if cursor:
+            try:
+                timestamp, id, direction, offset = _serializer().loads(cursor)
+                return (datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)), direction, int(offset)
+            except (BadData, ValueError, TypeError):  # 无效的游标，从第一页开始
+                pass
+        return None, None, 0
+
+
+def approximate_count(name, query):
+    """缓存 COUNT(*) 的结果 BREAKBLOG_PAGINATION_COUNT_TIMEOUT 秒，用于显示大致的总数。"""
+    counts = current_app.extensions.setdefault('breakblog_counts', {})
+    cached = counts.get(name)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    total = query.order_by(None).count()
+    counts[name] = (time.time() + current_app.config['BREAKBLOG_PAGINATION_COUNT_TIMEOUT'], total)
+    return total
+
+
+def paginate(query, model, per_page, descending=True, total=None):
+    """按 model.timestamp 排序分页。
+
+    BREAKBLOG_PAGINATION 为 'keyset' 时使用游标分页，查询参数为 cursor，total 为可选的总数；
+    为 'offset' 时使用 Flask-SQLAlchemy 的 paginate()，查询参数为 page。
+    """
+    if current_app.config['BREAKBLOG_PAGINATION'] == 'keyset':
+        return KeysetPagination(query, model, per_page, request.args.get('cursor'), descending, total)
+    page = request.args.get('page', 1, type=int)
+    if descending:  # 与游标分页相同，timestamp 相同时按 id 排序，保证每页的内容确定
+        order = model.timestamp.desc(), model.id.desc()
+    else:
+        order = model.timestamp.asc(), model.id.asc()
+    return query.order_by(*order).paginate(page, per_page)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+
+class RateLimitExceeded(TooManyRequests):
+    """超过限制时抛出，retry_after 为可以再次请求的秒数，由 429 错误处理函数写入 Retry-After 响应头。"""
+
+    def __init__(self, retry_after):
+        super(RateLimitExceeded, self).__init__()
+        self.retry_after = int(math.ceil(retry_after))
+
+
+def _refill(tokens, updated, now, capacity, period):
+    """令牌桶：容量为 capacity，每 period / capacity 秒恢复一个令牌。"""
+    return min(float(capacity), tokens + (now - updated) * capacity / float(period))
+
+
+class MemoryStorage(object):
+    """进程内的令牌桶，多个 worker 各自计数。"""
+
+    def __init__(self, max_age, max_entries=10000):
+        self.max_age = max_age  # 超过该时间没有请求的桶已经恢复满，可以删除
+        self.max_entries = max_entries
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """取出一个令牌，返回 0（允许）或需要等待的秒数。"""
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = _refill(tokens, updated, now, capacity, period)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                if len(self._buckets) > self.max_entries:
+                    self._purge(now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) * period / float(capacity)
+
+    def _purge(self, now):
+        # 删除已经恢复满的桶，它们和不存在的桶等价
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if now - updated >= self.max_age:
+                del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteStorage(object):
+    """保存在缓存目录中单独的 SQLite 文件里的令牌桶，所有 worker 共享计数，不占用博客数据库的写锁。"""
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+        # 建表使用临时连接，预先 fork 的 worker 不会继承主进程的连接
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # isolation_level=None 时自行控制事务，BEGIN IMMEDIATE 保证读取和写入之间没有其他进程修改
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, period):
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens = _refill(row[0], row[1], now, capacity, period) if row else float(capacity)
+            wait = 0 if tokens >= 1 else (1 - tokens) * period / float(capacity)
+            if not wait:
+                tokens -= 1
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            if not row and random.random() < 0.01:  # 新建桶时偶尔删除已经恢复满的桶
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - self.max_age,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self._connect().execute('DELETE FROM bucket')
+
+
+class RateLimiter(object):
+    """按客户端 IP 和名称限制请求频率。
+
+    BREAKBLOG_RATELIMITS 为 {名称: (次数, 秒)}，每个 IP 最多连续请求“次数”次，之后每 秒/次数 秒恢复一次；
+    BREAKBLOG_RATELIMIT_STORAGE 为 None 时关闭，'memory' 每个进程单独计数，'sqlite' 多个 worker 共享计数。
+    超过限制时返回 429，Retry-After 为需要等待的秒数。已登录的管理员不受限制。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        storage = app.config['BREAKBLOG_RATELIMIT_STORAGE']
+        max_age = max([period for capacity, period in app.config['BREAKBLOG_RATELIMITS'].values()] or [0])
+        if storage == 'memory':
+            app.extensions['breakblog_ratelimit'] = MemoryStorage(max_age)
+        elif storage == 'sqlite':
+            os.makedirs(app.config['BREAKBLOG_CACHE_PATH'], exist_ok=True)
+            app.extensions['breakblog_ratelimit'] = SQLiteStorage(
+                os.path.join(app.config['BREAKBLOG_CACHE_PATH'], 'ratelimit.db'), max_age)
+        else:
+            app.extensions['breakblog_ratelimit'] = None
+
+    def limit(self, name, methods=('POST',)):
+        """限制视图中 methods 请求的频率，放在 route() 装饰器下面。"""
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method in methods:
+                    self.hit(name)
+                return f(*args, **kwargs)
+
+            return decorated_function
+
+        return decorator
+
+    def hit(self, name):
+        storage = current_app.extensions['breakblog_ratelimit']
+        if storage is None or current_user.is_authenticated:
+            return
+        capacity, period = current_app.config['BREAKBLOG_RATELIMITS'][name]
+        wait = storage.take('%s:%s' % (name, request.remote_addr), capacity, period)
+        if wait:
+            current_app.logger.warning('Rate limit %s exceeded by %s.', name, request.remote_addr)
+            raise RateLimitExceeded(wait)
+
+    def reset(self):
+        storage = current_app.extensions['breakblog_ratelimit']
+        if storage is not None:
+            storage.clear()
+
+
+ratelimit = RateLimiter()
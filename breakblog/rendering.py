@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import json
+import math
+import re
+from html import escape
+from html.parser import HTMLParser
+
+from flask import current_app
+
+from breakblog.images import images, IMAGE_FILENAME, variant_filename
+from breakblog.utils import strip_html
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'cite', 'code', 'del', 'div', 'em', 'figcaption', 'figure',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li', 'mark', 'ol', 'p', 'pre', 'q', 's',
+    'small', 'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u',
+    'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    '*': {'class', 'style', 'title', 'lang', 'dir'},
+    'a': {'href', 'target', 'rel', 'name'},
+    'img': {'src', 'alt', 'width', 'height', 'srcset', 'sizes'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan', 'scope'},
+    'ol': {'start', 'type'},
+}
+VOID_TAGS = {'br', 'hr', 'img'}
+SKIP_TAGS = {'script', 'style', 'iframe', 'object', 'embed', 'frame', 'frameset', 'noscript', 'template'}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+URL_ATTRIBUTES = {'href', 'src'}
+SAFE_URL = re.compile(r'^(?:https?:|mailto:|/|#|\.|[^:/?#]*(?:[/?#]|$))', re.IGNORECASE)
+UNSAFE_STYLE = re.compile(r'expression|url\s*\(|javascript:|behaviou?r', re.IGNORECASE)
+
+# 正文图片的 sizes 属性，文章正文栏最宽约 960 像素
+IMAGE_SIZES = '(max-width: 960px) 100vw, 960px'
+
+CJK = '぀-ヿ㐀-䶿一-鿿豈-﫿가-힯'
+WORD = re.compile(r'[%s]|[^\W%s]+' % (CJK, CJK))
+
+
+def slugify(text):
+    slug = re.sub(r'[^\w\s-]', '', text.lower()).strip()
+    return re.sub(r'[\s_-]+', '-', slug) or 'section'
+
+
+class PostSanitizer(HTMLParser):
+    """按白名单过滤 CKEditor 生成的 HTML，并为标题添加 id、为上传的图片添加 srcset。
+
+    不在白名单中的标签只保留文字内容，script、style 等标签连同内容一起删除；
+    事件属性、javascript: 链接和包含 expression()、url() 的样式会被删除，未闭合的标签在末尾补全。
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.parts = []
+        self.stack = []
+        self.skip = 0
+        self.heading = None  # (标签, 开始标签在 parts 中的位置, 标题文字, 原有的 id)
+        self.heading_attrs = []
+        self.ids = set()
+        self.toc = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            if tag not in VOID_TAGS:
+                self.skip += 1
+            return
+        if self.skip or tag not in ALLOWED_TAGS:
+            return
+        attrs = self._clean_attributes(tag, attrs)
+        if tag == 'img':
+            self._add_srcset(attrs)
+        if tag in HEADING_TAGS and self.heading is None:
+            # 标题的 id 由标题文字生成，结束标签处再写入开始标签
+            self.heading = (tag, len(self.parts), [], dict(attrs).get('id'))
+            self.parts.append(None)
+            attrs = [(name, value) for name, value in attrs if name != 'id']
+            self.heading_attrs = attrs
+        else:
+            self.parts.append(self._start_tag(tag, attrs))
+        if tag not in VOID_TAGS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self.stack and self.stack[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+            return
+        if self.skip or tag not in ALLOWED_TAGS or tag in VOID_TAGS or tag not in self.stack:
+            return
+        while self.stack:  # 同时关闭中间没有闭合的标签
+            open_tag = self.stack.pop()
+            if self.heading is not None and open_tag == self.heading[0]:
+                self._close_heading()
+            self.parts.append('</%s>' % open_tag)
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        if self.heading is not None:
+            self.heading[2].append(data)
+        self.parts.append(escape(data, quote=False))
+
+    def close(self):
+        HTMLParser.close(self)
+        while self.stack:
+            self.handle_endtag(self.stack[-1])
+
+    @property
+    def html(self):
+        return ''.join(self.parts)
+
+    def _close_heading(self):
+        tag, index, texts, heading_id = self.heading
+        text = re.sub(r'\s+', ' ', ''.join(texts)).strip()
+        base = slugify(heading_id or text)
+        heading_id, i = base, 2
+        while heading_id in self.ids:
+            heading_id = '%s-%d' % (base, i)
+            i += 1
+        self.ids.add(heading_id)
+        self.parts[index] = self._start_tag(tag, self.heading_attrs + [('id', heading_id)])
+        if text:
+            self.toc.append(dict(level=int(tag[1]), id=heading_id, text=text))
+        self.heading = None
+
+    @staticmethod
+    def _clean_attributes(tag, attrs):
+        allowed = ALLOWED_ATTRIBUTES['*'] | ALLOWED_ATTRIBUTES.get(tag, set())
+        if tag in HEADING_TAGS:
+            allowed = allowed | {'id'}
+        cleaned = []
+        for name, value in attrs:
+            value = value or ''
+            if name not in allowed:
+                continue
+            if name in URL_ATTRIBUTES and not SAFE_URL.match(re.sub(r'[\s\x00-\x1f]', '', value)):
+                continue
+            if name == 'style' and UNSAFE_STYLE.search(value):
+                continue
+            cleaned.append((name, value))
+        if tag == 'a' and dict(cleaned).get('target') == '_blank':
+            cleaned = [(name, value) for name, value in cleaned if name != 'rel'] + [('rel', 'noopener')]
+        return cleaned
+
+    @staticmethod
+    def _add_srcset(attrs):
+        values = dict(attrs)
+        src = values.get('src', '')
+        filename = src.rsplit('/', 1)[-1]
+        if 'srcset' in values or IMAGE_FILENAME.match(filename) is None:
+            return
+        size = images.size(filename)
+        widths = images.widths(filename, size[0] if size else None)
+        if not widths:
+            return
+        match = IMAGE_FILENAME.match(filename)
+        prefix = src[:len(src) - len(filename)]
+        candidates = ['%s%s %dw' % (prefix, variant_filename(match.group('digest'), match.group('ext'), width), width)
+                      for width in widths]
+        candidates.append('%s %dw' % (src, size[0]))
+        attrs.extend([('srcset', ', '.join(candidates)), ('sizes', IMAGE_SIZES), ('loading', 'lazy')])
+
+    @staticmethod
+    def _start_tag(tag, attrs):
+        return '<%s%s>' % (tag, ''.join(' %s="%s"' % (name, escape(value, quote=True)) for name, value in attrs))
+
+
+def count_words(text):
+    # 中日韩文字按字计算，其他文字按词计算
+    return len(WORD.findall(text))
+
+
+def make_excerpt(text, length):
+    if len(text) <= length:
+        return text
+    excerpt = text[:length]
+    space = excerpt.rfind(' ')
+    if space > length * 0.8:  # 尽量不截断英文单词
+        excerpt = excerpt[:space]
+    return excerpt.rstrip(' ,.;:，。；：、') + '…'
+
+
+def render_post(body):
+    """根据文章正文生成保存在 Post 中的衍生数据：过滤后的 HTML、摘要、字数、阅读时间和目录（JSON）。"""
+    sanitizer = PostSanitizer()
+    sanitizer.feed(body or '')
+    sanitizer.close()
+    html = sanitizer.html
+    text = strip_html(html)
+    word_count = count_words(text)
+    return dict(
+        body_html=html,
+        excerpt=make_excerpt(text, current_app.config['BREAKBLOG_EXCERPT_LENGTH']),
+        word_count=word_count,
+        reading_time=max(int(math.ceil(word_count / float(current_app.config['BREAKBLOG_READING_SPEED']))), 1),
+        toc=json.dumps(sanitizer.toc, ensure_ascii=False))
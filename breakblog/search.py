@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import re
+from collections import namedtuple
+
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from markupsafe import Markup, escape
+from sqlalchemy.exc import OperationalError
+
+from breakblog.extensions import db
+from breakblog.utils import strip_html
+
+SearchResult = namedtuple('SearchResult', ['post', 'title', 'snippet', 'rank'])
+
+# snippet() 和 highlight() 用控制字符标记匹配的词，转义 HTML 之后再替换成 <mark> 标签
+MARK_OPEN, MARK_CLOSE = '\x02', '\x03'
+
+
+class Search(object):
+    """基于 SQLite FTS5 的文章全文搜索。
+
+    虚拟表 post_fts 的 rowid 与 post.id 相同，保存标题、副标题和去掉 HTML 标签后的正文。
+    文章的新建、编辑和删除在同一个事务中同步更新索引，`flask reindex` 重建整个索引。
+    虚拟表在第一次使用时创建；数据库不是 SQLite 或没有编译 FTS5 时搜索不可用。
+    """
+
+    table = 'post_fts'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['breakblog_search'] = {'available': None}
+
+    @property
+    def available(self):
+        state = current_app.extensions['breakblog_search']
+        if state['available'] is None:
+            state['available'] = self._create_table()
+        return state['available']
+
+    def _create_table(self):
+        if db.engine.dialect.name != 'sqlite':
+            return False
+        tokenize = current_app.config['BREAKBLOG_SEARCH_TOKENIZE'].replace("'", "''")
+        try:
+            # 使用独立的连接提交建表语句，不影响当前 session 中的事务
+            with db.engine.begin() as connection:
+                connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, subtitle, body, tokenize='%s')"
+                    % (self.table, tokenize))
+        except OperationalError:  # 没有编译 FTS5 模块
+            current_app.logger.warning('SQLite FTS5 is not available, search is disabled.')
+            return False
+        return True
+
+    def index_post(self, post):
+        """更新一篇文章的索引，在提交文章修改之前调用，新文章需要先 flush() 获得 id。"""
+        if not self.available:
+            return
+        self.remove_post(post.id)
+        db.session.execute(
+            'INSERT INTO %s (rowid, title, subtitle, body) VALUES (:id, :title, :subtitle, :body)' % self.table,
+            dict(id=post.id, title=post.title, subtitle=post.subtitle or '', body=strip_html(post.body)))
+
+    def remove_post(self, post_id):
+        if not self.available:
+            return
+        db.session.execute('DELETE FROM %s WHERE rowid = :id' % self.table, dict(id=post_id))
+
+    def reindex(self, chunk_size=500):
+        """清空并重建索引，返回索引的文章数量，调用方负责提交事务。"""
+        from breakblog.models import Post
+
+        if not self.available:
+            return 0
+        db.session.execute('DELETE FROM %s' % self.table)
+        post = Post.__table__
+        count, last_id = 0, 0
+        while True:  # 按 id 分块读取，文章数量很多时内存占用不变
+            rows = db.session.execute(
+                db.select([post.c.id, post.c.title, post.c.subtitle, post.c.body]).where(
+                    post.c.id > last_id).order_by(post.c.id).limit(chunk_size)).fetchall()
+            if not rows:
+                return count
+            db.session.execute(
+                'INSERT INTO %s (rowid, title, subtitle, body) VALUES (:id, :title, :subtitle, :body)' % self.table,
+                [dict(id=row.id, title=row.title, subtitle=row.subtitle or '', body=strip_html(row.body))
+                 for row in rows])
+            count += len(rows)
+            last_id = rows[-1].id
+
+    def search(self, q, page, per_page):
+        """按 bm25 相关度返回第 page 页的 SearchResult，标题的权重高于副标题和正文。"""
+        from breakblog.models import Post
+
+        match = make_match_expression(q)
+        if not match or not self.available:
+            return Pagination(None, page, per_page, 0, [])
+        total = db.session.execute(
+            'SELECT count(*) FROM %s WHERE %s MATCH :match' % (self.table, self.table),
+            dict(match=match)).scalar()
+        rows = db.session.execute(
+            "SELECT rowid AS id, "
+            "highlight({table}, 0, :open, :close) AS title, "
+            "snippet({table}, -1, :open, :close, '…', :tokens) AS snippet, "
+            "bm25({table}, 10.0, 5.0, 1.0) AS rank "
+            "FROM {table} WHERE {table} MATCH :match "
+            "ORDER BY rank LIMIT :limit OFFSET :offset".format(table=self.table),
+            dict(match=match, open=MARK_OPEN, close=MARK_CLOSE,
+                 tokens=current_app.config['BREAKBLOG_SEARCH_SNIPPET_TOKENS'],
+                 limit=per_page, offset=(page - 1) * per_page)).fetchall()
+        posts = {post.id: post for post in Post.query.filter(Post.id.in_([row.id for row in rows])).all()}
+        items = [SearchResult(posts[row.id], highlight(row.title), highlight(row.snippet), row.rank)
+                 for row in rows if row.id in posts]
+        return Pagination(None, page, per_page, total, items)
+
+
+def make_match_expression(q):
+    """把用户输入的每个词用双引号括起来，避免 FTS5 查询语法（AND、NEAR、* 等）引发错误，多个词之间为 AND 关系。"""
+    terms = [term.replace('"', '""') for term in re.split(r'\s+', q or '') if term.strip('"')]
+    return ' '.join('"%s"' % term for term in terms)
+
+
+def highlight(text):
+    return Markup(escape(text or '')).replace(MARK_OPEN, Markup('<mark>')).replace(MARK_CLOSE, Markup('</mark>'))
+
+
+search = Search()
@@ -27,6 +27,12 @@ class BaseConfig(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # p143 配置变量决定是否追踪对象，建议关闭
     SQLALCHEMY_RECORD_QUERIES = True  # 可以用于显式地禁用或者启用查询记录
 
+    # 每个新的 SQLite 连接执行的 PRAGMA，例如 {'journal_mode': 'WAL', 'busy_timeout': 5000}
+    BREAKBLOG_SQLITE_PRAGMAS = {}
+    # 读写分离：博客前台的 GET 请求使用只读引擎，BREAKBLOG_DATABASE_READ_URL 为副本地址，未设置时与主库相同
+    BREAKBLOG_DATABASE_READ_SPLIT = False
+    BREAKBLOG_DATABASE_READ_URL = os.getenv('DATABASE_READ_URL')
+
     # 开启CSRF protection
     CKEDITOR_ENABLE_CSRF = True
     CKEDITOR_FILE_UPLOADER = 'admin.upload_image'
@@ -45,17 +51,84 @@ class BaseConfig(object):
 
     BREAKBLOG_EMAIL = os.getenv('BREAKBLOG_EMAIL')  # 网站管理员收件人邮箱地址
 
+    # 错误日志汇总邮件：每 BREAKBLOG_ERROR_MAIL_INTERVAL 秒最多发送一封，
+    # 相同的异常（类型和抛出位置）在 BREAKBLOG_ERROR_MAIL_THROTTLE 秒内只附带一次详情
+    BREAKBLOG_ERROR_MAIL_INTERVAL = 300
+    BREAKBLOG_ERROR_MAIL_THROTTLE = 3600
+    BREAKBLOG_LOG_QUEUE_SIZE = 10000  # 日志队列的长度，队列满时丢弃新日志而不阻塞请求
+
+    # 邮件发件箱：每个进程的后台发送线程数量，设为 0 时由单独运行的 flask mail-worker 发送
+    BREAKBLOG_MAIL_WORKERS = int(os.getenv('BREAKBLOG_MAIL_WORKERS', 1))
+    BREAKBLOG_MAIL_BATCH_SIZE = 50  # 每批领取的邮件数量，同一批复用一个 SMTP 连接
+    BREAKBLOG_MAIL_POLL_INTERVAL = 30  # 检查发件箱的间隔（秒）
+    BREAKBLOG_MAIL_MAX_ATTEMPTS = 5  # 超过该次数后不再重试，标记为 dead
+    BREAKBLOG_MAIL_RETRY_DELAY = 60  # 第一次重试的等待时间（秒），之后每次加倍
+    BREAKBLOG_MAIL_CLAIM_TIMEOUT = 600  # 领取后超过该时间仍未完成，视为发送者已退出，重新领取
+
     BREAKBLOG_POST_PER_PAGE = 10  # 每页面文章的数量
     BREAKBLOG_COMMENT_PER_PAGE = 15  # 每页评论列表数量
     BREAKBLOG_MANAGE_POST_PER_PAGE = 15  # p285 后台显示管理每页文章的数量
+    # 分页方式：'keyset' 基于 (timestamp, id) 的游标分页，'offset' 使用 COUNT(*) + OFFSET 的页码分页
+    BREAKBLOG_PAGINATION = os.getenv('BREAKBLOG_PAGINATION', 'keyset')
+    BREAKBLOG_PAGINATION_COUNT_TIMEOUT = 60  # 游标分页显示的总数缓存时间（秒）
 
     # ('theme name', 'display name') # 更换主题 p269
     # BREAKBLOG_THEMES = {'simplex': 'Simplex', 'darkly': 'Darkly'}
 
     BREAKBLOG_SLOW_QUERY_THRESHOLD = 1
 
+    # 登录和发表评论的频率限制：None 关闭，'memory' 每个进程单独计数，'sqlite' 多个 worker 共享缓存目录中的计数
+    BREAKBLOG_RATELIMIT_STORAGE = os.getenv('BREAKBLOG_RATELIMIT_STORAGE', 'memory')
+    # {名称: (次数, 秒)}，每个 IP 最多连续请求“次数”次，之后每 秒/次数 秒恢复一次
+    BREAKBLOG_RATELIMITS = {
+        'login': (5, 60),
+        'comment': (5, 300),
+    }
+    # 应用前面的反向代理数量，大于 0 时从 X-Forwarded-For 中读取客户端 IP（限流按 IP 计数）
+    BREAKBLOG_PROXY_COUNT = int(os.getenv('BREAKBLOG_PROXY_COUNT', 0))
+
+    # 按端点统计请求耗时、查询数量等指标，BREAKBLOG_SERVER_TIMING 控制是否输出 Server-Timing 响应头
+    BREAKBLOG_METRICS = True
+    BREAKBLOG_SERVER_TIMING = True
+    # Prometheus 抓取 /admin/metrics/prometheus 时使用的 Bearer 令牌，未设置时只允许登录后访问
+    BREAKBLOG_METRICS_TOKEN = os.getenv('BREAKBLOG_METRICS_TOKEN')
+
+    # 文章浏览量写入方式：'immediate' 每次浏览立即写入数据库，'buffered' 在内存中累加后批量写入
+    BREAKBLOG_PAGEVIEW_MODE = os.getenv('BREAKBLOG_PAGEVIEW_MODE', 'buffered')
+    BREAKBLOG_PAGEVIEW_FLUSH_INTERVAL = 10  # buffered 模式下的写入间隔（秒）
+    BREAKBLOG_PAGEVIEW_FLUSH_THRESHOLD = 500  # 未写入的浏览次数达到该值时提前写入
+
+    # 匿名访客的整页缓存：None 关闭，'memory' 进程内 LRU 缓存，'filesystem' 多个 worker 共享的文件缓存
+    BREAKBLOG_PAGE_CACHE = os.getenv('BREAKBLOG_PAGE_CACHE')
+    BREAKBLOG_PAGE_CACHE_TIMEOUT = 300  # 缓存过期时间（秒）
+    BREAKBLOG_PAGE_CACHE_MAX_ENTRIES = 1000
+
+    # 全文搜索使用的 FTS5 分词器，中文内容可以使用 'trigram'（需要 SQLite 3.34+）
+    BREAKBLOG_SEARCH_TOKENIZE = os.getenv('BREAKBLOG_SEARCH_TOKENIZE', 'unicode61 remove_diacritics 2')
+    BREAKBLOG_SEARCH_PER_PAGE = 10  # 搜索结果每页数量
+    BREAKBLOG_SEARCH_SNIPPET_TOKENS = 32  # 摘要中最多包含的词数
+    BREAKBLOG_FEED_SIZE = 20  # 订阅中的文章数量
+    BREAKBLOG_FEED_MAX_AGE = 300  # 订阅的缓存时间（秒），过期后阅读器带着 ETag 重新验证
+    BREAKBLOG_FEED_CACHE_MAX_ENTRIES = 200  # 进程内保存的订阅数量，每个域名和分类各占一个
+    BREAKBLOG_SITEMAP_SIZE = 50000  # 每个子 sitemap 中的 URL 数量，协议规定不超过 50000
+    BREAKBLOG_SITEMAP_CACHE_MAX_ENTRIES = 8  # 缓存目录中最多保留几组 sitemap 文件，每个域名和版本戳各一组
+    BREAKBLOG_EXCERPT_LENGTH = 200  # 文章列表中摘要的最大字符数
+    BREAKBLOG_READING_SPEED = 300  # 每分钟阅读的字数，用于计算阅读时间
+
+    # flask export 生成静态页面的目录；BREAKBLOG_STATIC_EXPORT 只在导出时由 flask export 设为 True
+    BREAKBLOG_EXPORT_PATH = os.getenv('BREAKBLOG_EXPORT_PATH', os.path.join(basedir, 'export'))
+    BREAKBLOG_STATIC_EXPORT = False
+
     BREAKBLOG_UPLOAD_PATH = os.path.join(basedir, 'uploads')  # 上传路径
+    BREAKBLOG_CACHE_PATH = os.path.join(basedir, 'cache')  # 缓存目录，保存各 worker 共享的版本戳等
     BREAKBLOG_ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
+    # 上传图片生成的缩小版本宽度（像素），以及生成缩小版本和 WebP 版本的后台线程数量，0 表示不生成
+    BREAKBLOG_IMAGE_WIDTHS = [480, 960, 1600]
+    BREAKBLOG_IMAGE_WORKERS = int(os.getenv('BREAKBLOG_IMAGE_WORKERS', 2))
+    # 上传文件交给前端服务器发送：None 由 Python 发送，'x-accel-redirect'（nginx）或 'x-sendfile'（Apache、lighttpd）
+    BREAKBLOG_MEDIA_OFFLOAD = os.getenv('BREAKBLOG_MEDIA_OFFLOAD')
+    # X-Accel-Redirect 使用的 nginx internal location，需要指向 BREAKBLOG_UPLOAD_PATH
+    BREAKBLOG_MEDIA_ACCEL_PREFIX = '/_uploads'
 
     # https://github.com/greyli/flask-ckeditor
     CKEDITOR_HEIGHT = 360  # 配置ckeditor插件
@@ -68,12 +141,34 @@ class DevelopmentConfig(BaseConfig):
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    BREAKBLOG_PAGEVIEW_MODE = 'immediate'
+    BREAKBLOG_MAIL_WORKERS = 0
+    BREAKBLOG_RATELIMIT_STORAGE = None
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # in-memory database
 
 
 class ProductionConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.getenv(
         'DATABASE_URL', prefix + os.path.join(basedir, 'data.db'))
+    # 每个进程保持 pool_size 个连接，超过一小时的连接重新建立
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+    }
+    # WAL 模式下读取不会被写事务阻塞；synchronous=NORMAL 在 WAL 模式下不会损坏数据库，只可能丢失断电前最后的事务
+    BREAKBLOG_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # 等待写锁的毫秒数，超时后才报 database is locked
+        'cache_size': -20000,  # 负数表示 KiB，即每个连接约 20 MB 页缓存
+        'mmap_size': 268435456,  # 256 MB 内存映射读取
+        'temp_store': 'MEMORY',
+    }
+    BREAKBLOG_DATABASE_READ_SPLIT = True
+    BREAKBLOG_RATELIMIT_STORAGE = os.getenv('BREAKBLOG_RATELIMIT_STORAGE', 'sqlite')
+    BREAKBLOG_PAGE_CACHE = os.getenv('BREAKBLOG_PAGE_CACHE', 'filesystem')
 
 
 config = {
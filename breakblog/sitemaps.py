@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: tw.huang
+    :github_url: https://github.com/tw-huang
+    :email: tw.huang@foxmail.com
+"""
+import gzip
+import hashlib
+import os
+import time
+import uuid
+from xml.sax.saxutils import escape
+
+from flask import current_app, request, url_for, send_file, abort
+
+from breakblog.caching import generations
+from breakblog.extensions import db
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+# 替换成文章 id 的占位数字，避免为每篇文章调用一次 url_for()
+POST_ID_PLACEHOLDER = 987654321
+STALE_AFTER = 3600  # 版本戳变化后旧文件保留的时间（秒），正在读取它们的请求不受影响
+
+
+def _lastmod(timestamp, updated_at=None):
+    if updated_at is not None and updated_at > timestamp:
+        timestamp = updated_at
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+class Sitemaps(object):
+    """sitemap 索引和分块的子 sitemap。
+
+    /sitemap.xml 是索引，列出 /sitemap-pages.xml.gz（首页、关于和分类页）以及按文章 id 分块的
+    /sitemap-posts-<n>.xml.gz，每块最多 BREAKBLOG_SITEMAP_SIZE 个 URL（协议规定的上限为 50000）。
+    子 sitemap 用 yield_per 分批读取文章的 id 和时间，边读取边写入 gzip 文件，内存占用与文章数量无关。
+    生成的文件保存在缓存目录中，'site' 或 'posts' 版本戳变化后才重新生成；
+    文件中是包含域名的绝对地址，每个域名单独生成，最多保留 BREAKBLOG_SITEMAP_CACHE_MAX_ENTRIES 组。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        path = os.path.join(app.config['BREAKBLOG_CACHE_PATH'], 'sitemaps')
+        os.makedirs(path, exist_ok=True)
+        app.extensions['breakblog_sitemaps'] = path
+
+    def _key(self):
+        # 文件中是包含域名的绝对地址，域名和版本戳都相同时才能使用已经生成的文件
+        stamps = [generations.get('site'), generations.get('posts')]
+        return hashlib.sha1(repr((request.host_url, stamps)).encode('utf-8')).hexdigest()[:16]
+
+    def _send(self, name, build, mimetype):
+        key = self._key()
+        path = os.path.join(current_app.extensions['breakblog_sitemaps'], '%s-%s' % (key, name))
+        if not os.path.exists(path):
+            self._remove_stale(key)
+            tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+            try:
+                build(tmp_path)
+                os.replace(tmp_path, path)  # 原子替换，并发请求不会读到写了一半的文件
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return send_file(path, mimetype=mimetype, conditional=True, cache_timeout=3600)
+
+    @staticmethod
+    def _remove_stale(key):
+        # 删除版本戳变化后留下的旧文件；文件按 key 分组，只保留最近写入的几组，伪造 Host 的请求不会让缓存目录无限增长
+        directory = current_app.extensions['breakblog_sitemaps']
+        now = time.time()
+        groups = {}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:  # 其他进程已经删除
+                continue
+            groups.setdefault(name.split('-', 1)[0], []).append((path, mtime))
+        groups.pop(key, None)
+        keep = current_app.config['BREAKBLOG_SITEMAP_CACHE_MAX_ENTRIES'] - 1  # 当前这一组也算在内
+        newest = sorted(groups, key=lambda group: max(mtime for path, mtime in groups[group]), reverse=True)
+        for number, group in enumerate(newest):
+            for path, mtime in groups[group]:
+                if number >= keep or now - mtime > STALE_AFTER:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def index(self):
+        return self._send('index.xml', self._build_index, 'application/xml')
+
+    def pages(self):
+        return self._send('pages.xml.gz', self._build_pages, 'application/gzip')
+
+    def posts(self, number):
+        return self._send('posts-%d.xml.gz' % number, lambda path: self._build_posts(path, number), 'application/gzip')
+
+    def _build_index(self, path):
+        from breakblog.models import Post
+
+        size = current_app.config['BREAKBLOG_SITEMAP_SIZE']
+        chunk = ((Post.id - 1) / size).label('chunk')
+        # 每块文章的最后修改时间，GROUP BY 只返回非空的块
+        rows = db.session.query(chunk, db.func.max(Post.timestamp), db.func.max(Post.updated_at)).group_by(
+            chunk).order_by(chunk)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="%s">\n' % SITEMAP_NS)
+            f.write('<sitemap><loc>%s</loc></sitemap>\n' % escape(url_for('blog.sitemap_pages', _external=True)))
+            for number, timestamp, updated_at in rows:
+                f.write('<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>\n' % (
+                    escape(url_for('blog.sitemap_posts', number=int(number) + 1, _external=True)),
+                    _lastmod(timestamp, updated_at)))
+            f.write('</sitemapindex>\n')
+
+    def _build_pages(self, path):
+        from breakblog.models import Category
+
+        urls = [url_for('blog.index', _external=True), url_for('blog.about', _external=True)]
+        urls.extend(url_for('blog.show_category', category_id=category_id, _external=True)
+                    for category_id, in db.session.query(Category.id).order_by(Category.id))
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="%s">\n' % SITEMAP_NS)
+            for url in urls:
+                f.write('<url><loc>%s</loc></url>\n' % escape(url))
+            f.write('</urlset>\n')
+
+    def _build_posts(self, path, number):
+        from breakblog.models import Post
+
+        size = current_app.config['BREAKBLOG_SITEMAP_SIZE']
+        max_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+        if not 1 <= number <= (max_id - 1) // size + 1:  # 不为不存在的块生成文件
+            abort(404)
+        url = escape(url_for('blog.show_post', post_id=POST_ID_PLACEHOLDER, _external=True))
+        prefix, suffix = url.split(str(POST_ID_PLACEHOLDER))
+        # 第 number 块为 id 在 ((number - 1) * size, number * size] 之间的文章，新文章只影响最后一块
+        rows = db.session.query(Post.id, Post.timestamp, Post.updated_at).filter(
+            Post.id > (number - 1) * size, Post.id <= number * size).order_by(Post.id).yield_per(5000)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="%s">\n' % SITEMAP_NS)
+            for post_id, timestamp, updated_at in rows:
+                f.write('<url><loc>%s%d%s</loc><lastmod>%s</lastmod></url>\n'
+                        % (prefix, post_id, suffix, _lastmod(timestamp, updated_at)))
+            f.write('</urlset>\n')
+
+
+sitemaps = Sitemaps()
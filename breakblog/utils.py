@@ -10,6 +10,9 @@ try:
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
+import re
+from html.parser import HTMLParser
+
 from flask import request, redirect, url_for, current_app
 
 
@@ -32,3 +35,39 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower(
            ) in current_app.config['BREAKBLOG_ALLOWED_IMAGE_EXTENSIONS']
+
+
+class _TextExtractor(HTMLParser):
+    skip_tags = {'script', 'style'}
+    # 块级元素前后补一个空格，避免相邻段落的文字连在一起
+    block_tags = {'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'table', 'blockquote', 'pre',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'img', 'figure', 'figcaption'}
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self._skip += 1
+        elif tag in self.block_tags:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in self.block_tags:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+# 去掉 CKEditor 生成的 HTML 标签，返回纯文本（实体已转换，空白合并为一个空格）
+def strip_html(html):
+    parser = _TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    return re.sub(r'\s+', ' ', ''.join(parser.parts)).strip()
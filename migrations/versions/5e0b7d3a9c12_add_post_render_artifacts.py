@@ -0,0 +1,36 @@
+"""add post render artifacts
+
+Revision ID: 5e0b7d3a9c12
+Revises: c27e95a4f1b8
+Create Date: 2026-10-18 16:12:40.318522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0b7d3a9c12'
+down_revision = 'c27e95a4f1b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('body_html', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('excerpt', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('word_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('reading_time', sa.Integer(), server_default='1', nullable=False))
+        batch_op.add_column(sa.Column('toc', sa.Text(), nullable=True))
+
+    # 已有文章的衍生数据需要应用代码生成，升级后执行 flask render-posts 回填
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('toc')
+        batch_op.drop_column('reading_time')
+        batch_op.drop_column('word_count')
+        batch_op.drop_column('excerpt')
+        batch_op.drop_column('body_html')
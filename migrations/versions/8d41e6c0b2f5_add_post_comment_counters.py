@@ -0,0 +1,36 @@
+"""add post comment counters
+
+Revision ID: 8d41e6c0b2f5
+Revises: 3f9c2b1d7a64
+Create Date: 2026-10-18 10:03:51.227164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41e6c0b2f5'
+down_revision = '3f9c2b1d7a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('reviewed_comment_count', sa.Integer(), server_default='0', nullable=False))
+
+    # 为已有文章回填评论数量
+    op.execute(
+        'UPDATE post SET '
+        'comment_count = (SELECT count(comment.id) FROM comment WHERE comment.post_id = post.id), '
+        'reviewed_comment_count = (SELECT count(comment.id) FROM comment '
+        'WHERE comment.post_id = post.id AND comment.reviewed = 1)'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('reviewed_comment_count')
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,29 @@
+"""add post updated_at
+
+Revision ID: d84a1c7e5b30
+Revises: a9d3f6b8e215
+Create Date: 2026-10-18 18:20:47.905316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd84a1c7e5b30'
+down_revision = 'a9d3f6b8e215'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # 已有文章的修改时间取发布时间
+    op.execute('UPDATE post SET updated_at = timestamp')
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')